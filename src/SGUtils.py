@@ -1,7 +1,10 @@
 
 import os
 import math
+import time
+import heapq
 import logging
+from collections import defaultdict
 logger = logging.getLogger('luigi-interface')
 alloc_log = logging.getLogger('alloc_log')
 alloc_log.setLevel(logging.DEBUG)
@@ -9,7 +12,8 @@ alloc_log.setLevel(logging.DEBUG)
 import luigi
 from luigi.contrib.slurm import SlurmExecutableTask
 from luigi.util import requires, inherits
-from src.utils import CheckTargetNonEmpty
+from src.utils import CheckTargetNonEmpty, SqliteStore, ModelledResources, cache_dir
+from src.scripts.scatter_vcf import scatter_regions
 
 picard="java -XX:+UseSerialGC -Xmx{mem}M -jar /tgac/software/testing/picardtools/2.1.1/x86_64/bin/picard.jar"
 python="source /usr/users/ga004/buntingd/FP_dev/dev/bin/activate"
@@ -17,23 +21,102 @@ python="source /usr/users/ga004/buntingd/FP_dev/dev/bin/activate"
 # Ugly hack
 script_dir = os.path.join(os.path.split(__file__)[0], 'scripts')
 
-class ScatterVCF(SlurmExecutableTask):
+###############################################################################
+#                            Scatter width                                    #
+###############################################################################
+
+class ScatterHistory(SqliteStore):
+    '''Runtime of every shard of each scattered task family, against the work units in the shard'''
+    schema = ["CREATE TABLE IF NOT EXISTS shards (family TEXT, work REAL, seconds REAL, finished REAL)"]
+    
+    def runtimes(self, family, limit=1000):
+        rows = self._query("SELECT work, seconds FROM shards WHERE family=? ORDER BY finished DESC LIMIT ?", (family, limit))
+        return rows or []
+    
+    def record(self, family, work, seconds):
+        self._query("INSERT INTO shards VALUES (?, ?, ?, ?)", (family, work, seconds, time.time()), commit=True)
+
+scatter_history = ScatterHistory(os.path.join(cache_dir, 'scatter_history.sqlite'))
+
+# (work, width) chosen for each task family by scatter_width, so TimedShard can record against it
+scatter_plans = {}
+
+def fit_shard_time(runtimes, overhead):
+    '''Least squares fit of seconds = c + k*work to past shard runtimes. With too little spread
+    in the work the fixed ``overhead`` is used for c'''
+    n = len(runtimes)
+    mean_w = sum([w for w,t in runtimes])/n
+    mean_t = sum([t for w,t in runtimes])/n
+    var_w = sum([(w - mean_w)**2 for w,t in runtimes])
+    if var_w > (0.1*mean_w)**2*n:
+        k = sum([(w - mean_w)*(t - mean_t) for w,t in runtimes])/var_w
+        c = mean_t - k*mean_w
+        if k > 0 and c >= 0:
+            return c, k
+    rates = sorted([max(t - overhead, 0)/w for w,t in runtimes if w > 0])
+    return overhead, rates[len(rates)//2] if rates else 0
+
+def scatter_width(family, work, default=5):
+    '''Choose the number of shards for ``family`` over ``work`` units (eg bytes of input in the mask)
+    that minimises the predicted makespan. Each shard is predicted to take c + k*work/N seconds from
+    the shard runtimes in scatter_history, at most ``slots`` shards run at once, and each shard adds
+    ``gather_cost`` seconds to the scatter and gather. Without history the work is split into shards of
+    ``work_per_shard``. The [scatter] section of luigi.cfg sets max_width, slots, shard_overhead,
+    gather_cost and work_per_shard'''
+    config = luigi.configuration.get_config()
+    max_width = config.getint('scatter', 'max_width', 100)
+    slots = config.getint('scatter', 'slots', 50)
+    overhead = config.getfloat('scatter', 'shard_overhead', 120.)
+    gather_cost = config.getfloat('scatter', 'gather_cost', 10.)
+    work_per_shard = config.getfloat('scatter', 'work_per_shard', 2e9)
+    
+    runtimes = scatter_history.runtimes(family)
+    if work <= 0:
+        width = default
+    elif not runtimes:
+        width = min(max(int(math.ceil(work/work_per_shard)), 1), max_width)
+    else:
+        c, k = fit_shard_time(runtimes, overhead)
+        makespan = lambda N: (c + k*work/N)*math.ceil(N/slots) + gather_cost*N
+        width = min(range(1, max_width + 1), key=makespan)
+        logger.info("{0}: shard time {1:.0f} + {2:.3g}*work s from {3} shards, predicted makespan {4:.0f} s".format(
+                    family, c, k, len(runtimes), makespan(width)))
+        
+    logger.info("Scattering {0} over {1} work units {2} ways".format(family, work, width))
+    scatter_plans[family] = (work, width)
+    return width
+
+class TimedShard(object):
+    '''Mixin for the shard task of a ScatterGather, records its runtime in scatter_history
+    if scatter_width chose the width of its task family'''
+    def run(self):
+        start = time.time()
+        super().run()
+        for cls in type(self).__mro__:
+            if cls.__name__ in scatter_plans:
+                work, width = scatter_plans[cls.__name__]
+                scatter_history.record(cls.__name__, work/width, time.time() - start)
+                break
+
+class ScatterVCF(ModelledResources, SlurmExecutableTask):
+    '''Splits the bgzipped input VCF into bgzipped and tabix indexed shards at position boundaries.
+    :param str split_by: balance the shards by compressed ``size``, ``records`` or genomic ``position``'''
+    split_by = luigi.Parameter(default='size', significant=False)
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
-        self.mem = 8000
-        self.n_cpu = 1
+        self.mem = 2000
+        self.n_cpu = 4
         self.partition = "tgac-medium"
 
     def work_script(self):
         return '''#!/bin/bash
-                source vcftools-0.1.13;
                 set -eo pipefail
                 {python}
                 mkdir -p {dir}/temp
                 
-                bgzip -cd {input} | python {script_dir}/spilt_VCF.py {dir}/temp/{base} {N_scatter}
+                python {script_dir}/scatter_vcf.py --threads {n_cpu} --split-by {split_by} {input} {dir}/temp/{base} {N_scatter}
                 
                 mv {dir}/temp/* {dir}
                 rmdir {dir}/temp
@@ -41,58 +124,225 @@ class ScatterVCF(SlurmExecutableTask):
                            dir=os.path.split(self.output()[0].path)[0],
                            base=os.path.split(self.output()[0].path)[1][:-7],
                            script_dir=script_dir,
+                           n_cpu=self.n_cpu,
+                           split_by=self.split_by,
                            input=self.input().path,
                            N_scatter=len(self.output()))
 
-class ScatterBED(luigi.Task, CheckTargetNonEmpty):
+class ScatterVCFRegions(luigi.Task):
+    '''Virtual scatter, splits the tabix index of the input VCF into one list of regions per output
+    instead of rewriting the records. Each output holds a ``#source_vcf=`` line then its regions as BED,
+    the plain BED is also written to output.bed for bcftools -R/-T and GATK -L. Shard tasks should
+    subclass VirtualShard to read their regions straight out of the source VCF'''
+    def run(self):
+        vcf = os.path.abspath(self.input().path)
+        if not os.path.exists(vcf + '.tbi'):
+            raise Exception("ScatterVCFRegions needs a tabix index for " + vcf)
+        shards = scatter_regions(vcf, len(self.output()))
+        if len(shards) < len(self.output()):
+            # The shard tasks still exist, VirtualShard has them write an empty VCF rather than pass
+            # an empty region list on to bcftools or GATK
+            logger.warning("{0} only has enough indexed data for {1} of the {2} shards".format(vcf, len(shards), len(self.output())))
+            shards += [[]]*(len(self.output()) - len(shards))
+        
+        for out, regions in zip(self.output(), shards):
+            bed = "".join(["{0}\t{1}\t{2}\n".format(*x) for x in regions])
+            with open(out.path + '.bed', 'w') as fout:
+                fout.write(bed)
+            with out.open('w') as fout:
+                fout.write("#source_vcf={0}\n".format(vcf) + bed)
+            logger.info("{0}: {1} regions".format(out.path, len(regions)))
+
+class VirtualShard(object):
+    '''Mixin for the shard task of a ScatterGather so it can take either a VCF shard from ScatterVCF
+    or a region list from ScatterVCFRegions'''
+    def shard_input(self):
+        '''Returns the VCF to read and the BED of regions to restrict it to, None for a real shard'''
+        path = self.input().path
+        with open(path, 'rb') as f:
+            first = f.readline()
+        if first.startswith(b'#source_vcf='):
+            return first[len(b'#source_vcf='):].strip().decode(), path + '.bed'
+        return path, None
+    
+    def empty_shard(self, regions):
+        '''Whether ScatterVCFRegions had no regions left for this shard'''
+        return regions is not None and os.path.getsize(regions) == 0
+        
+    def empty_shard_script(self, vcf, outputs):
+        '''Script writing the header of ``vcf`` with no records to each of ``outputs``, for an empty shard'''
+        return '''#!/bin/bash
+                source bcftools-1.3.1;
+                set -eo pipefail
+                
+                {writes}
+                '''.format(writes="\n                ".join(["bcftools view -h {vcf} | bgzip -c > {0}.temp && tabix -p vcf {0}.temp && "
+                                                              "mv {0}.temp.tbi {0}.tbi && mv {0}.temp {0}".format(x, vcf=vcf)
+                                                              for x in outputs]))
+    
+    def region_flags(self, regions, tool='bcftools'):
+        '''Command line flags restricting ``tool`` to ``regions``. bcftools jumps to the regions
+        with the index (-R) and keeps only records starting in them (-T), so records spanning
+        a split aren't duplicated'''
+        if regions is None:
+            return ''
+        elif tool == 'gatk':
+            return '-L ' + regions
+        return '-R {0} -T {0}'.format(regions)
 
+class ScatterBED(luigi.Task, CheckTargetNonEmpty):
+    '''Splits the input BED into one shard per output.
+    :param str scatter_strategy: ``contiguous`` fills the shards in file order,
+        ``binpack`` assigns intervals largest first to the least loaded shard
+    :param int max_interval: For ``binpack``, intervals longer than this are split at multiples of it
+        from the interval start. 0 uses the target shard size
+    :param str weights: Optional tab separated file of contig and relative cost per base, eg from
+        variant density or past runtimes. Contigs not listed get the mean weight
+    '''
+    scatter_strategy = luigi.Parameter(default='contiguous', significant=False)
+    max_interval = luigi.IntParameter(default=0, significant=False)
+    weights = luigi.Parameter(default='', significant=False)
+    
     def __init__(self, *args, **kwargs):
         super().__init__( *args, **kwargs)
+        if self.scatter_strategy not in ('contiguous', 'binpack'):
+            raise ValueError("Unknown scatter_strategy " + self.scatter_strategy)
+    
+    def read_weights(self):
+        weights = {}
+        if self.weights:
+            with open(self.weights) as f:
+                for l in f:
+                    if l.strip():
+                        contig, w = l.split()[:2]
+                        weights[contig] = float(w)
+        return defaultdict(lambda: sum(weights.values())/len(weights) if weights else 1.0, weights)
     
     def run(self):
-        with self.input().open() as fin:
+        # The BED may come with other requirements of the scattered task, eg GenotypeGVCF with CombineGVCFs
+        bed = self.input()['intervals'] if isinstance(self.input(), dict) else self.input()
+        with bed.open() as fin:
             inp = [(l, int(l.split()[2]) - int(l.split()[1]) ) for l in fin]
             
+        if self.scatter_strategy == 'binpack':
+            shards = self.binpack(inp)
+        else:
+            shards = self.contiguous(inp)
+            
+        for out, shard in zip(self.output(), shards):
+            with out.open('w') as fout:
+                fout.writelines([x[0] for x in shard])
+                
+        self.log_balance(shards)
+                
+    def contiguous(self, inp):
+        '''Fill each shard in file order until it holds more than its share of the sequence'''
         total_seq_len = sum([x[1] for x in inp])
         perfile = math.ceil(total_seq_len/len(self.output()))        
         
         inp_iter = iter(inp)
-        files = 0
-        for i,out in enumerate(self.output()):
+        shards = []
+        for i in range(len(self.output())):
             count = 0
-            with out.open('w') as fout:
-                for l,c in inp_iter:
-                    fout.write(l)
-                    count += c
-                    if count > perfile:
-                        break
-                        
-                files+=1                
-                if files == len(self.output()):
-                    #If we're on the final file dump the rest
-                    fout.writelines([x[0] for x in inp_iter])
-
-class GatherVCF(SlurmExecutableTask, CheckTargetNonEmpty):
+            shard = []
+            for l,c in inp_iter:
+                shard.append((l,c))
+                count += c
+                if count > perfile:
+                    break
+            shards.append(shard)
+            
+        #Dump the rest in the final shard
+        shards[-1].extend(inp_iter)
+        return shards
+        
+    def split(self, line, max_len):
+        '''Split a BED line into pieces of at most max_len, keeping any extra columns'''
+        fields = line.rstrip('\n').split('\t')
+        start, end = int(fields[1]), int(fields[2])
+        for s in range(start, end, max_len):
+            e = min(s + max_len, end)
+            yield "\t".join([fields[0], str(s), str(e)] + fields[3:]) + "\n", e - s
+    
+    def binpack(self, inp):
+        '''Longest processing time first bin packing of the (split) intervals by weighted length.
+        Each shard keeps its intervals in file order'''
+        N = len(self.output())
+        max_len = self.max_interval or max(1, math.ceil(sum([x[1] for x in inp])/N))
+        
+        items = []
+        for l,c in inp:
+            items.extend(self.split(l, max_len) if c > max_len else [(l,c)])
+        weights = self.read_weights()
+        costs = [c*weights[l.split()[0]] for l,c in items]
+        
+        loads = [(0., i) for i in range(N)]
+        assigned = [[] for i in range(N)]
+        for idx in sorted(range(len(items)), key=lambda i: costs[i], reverse=True):
+            load, i = heapq.heappop(loads)
+            assigned[i].append(idx)
+            heapq.heappush(loads, (load + costs[idx], i))
+            
+        return [[items[idx] for idx in sorted(a)] for a in assigned]
+        
+    def log_balance(self, shards):
+        weights = self.read_weights()
+        costs = [sum([c*weights[l.split()[0]] for l,c in shard]) for shard in shards]
+        mean = sum(costs)/len(costs) if costs else 0
+        logger.info("ScatterBED {0}: {1} shards, cost min {2:.3g} mean {3:.3g} max {4:.3g}, max/mean {5:.2f}".format(
+                    self.scatter_strategy, len(costs), min(costs), mean, max(costs), max(costs)/mean if mean else float('nan')))
+        for out, shard, cost in zip(self.output(), shards, costs):
+            logger.info("    {0}: {1} intervals, cost {2:.3g}".format(out.path, len(shard), cost))
+
+class GatherVCF(ModelledResources, SlurmExecutableTask, CheckTargetNonEmpty):
+    '''Gathers the bgzipped VCF shards. By default the compressed blocks of coordinate ordered shards are
+    concatenated as they are and indexed with tabix. Shards that overlap, eg from ScatterBED binpack,
+    are merged with Picard MergeVcfs instead.
+    :param str gather_mode: ``concat``, or ``merge`` to always use MergeVcfs'''
+    gather_mode = luigi.Parameter(default='concat', significant=False)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs) 
         # Set the SLURM request params for this task
-        self.mem = 8000
-        self.n_cpu = 1
+        self.mem = 2000
+        self.n_cpu = 4
         self.partition = "tgac-medium"
         
+    def merges(self):
+        '''(output, inputs) pairs to merge. The task output goes last so it only exists once the rest do'''
+        return [(self.output().path, [x.path for x in self.input()])]
+        
     def work_script(self):
+        concat = '''rc=0
+                python {script_dir}/concat_vcf.py --threads {n_cpu} {output}.temp.vcf.gz {inputs} || rc=$?
+                if [ $rc -eq 0 ]; then
+                    tabix -p vcf {output}.temp.vcf.gz
+                elif [ $rc -eq 3 ]; then
+                    $picard MergeVcfs O={output}.temp.vcf.gz {in_flags}
+                else
+                    exit $rc
+                fi
+                ''' if self.gather_mode == 'concat' else '''$picard MergeVcfs O={output}.temp.vcf.gz {in_flags}
+                '''
+        merge = concat + '''
+                mv {output}.temp.vcf.gz {output}
+                mv {output}.temp.vcf.gz.tbi {output}.tbi
+                '''
         return '''#!/bin/bash
                 picard='{picard}'
                 source vcftools-0.1.13;
+                source bcftools-1.3.1;
                 source jre-8u92
+                {python}
                 
                 set -eo pipefail
-                $picard MergeVcfs O={output}.temp.vcf.gz {in_flags} 
-                
-                mv {output}.temp.vcf.gz {output}
-                
+                {merges}
                 '''.format(picard=picard.format(mem=self.mem*self.n_cpu),
-                           output=self.output().path,
-                           in_flags=  "\\\n".join([" I= "+ x.path for x in self.input()])
+                           python=python,
+                           merges="\n                ".join([merge.format(output=output,
+                                                                           script_dir=script_dir,
+                                                                           n_cpu=self.n_cpu,
+                                                                           inputs=" ".join(inputs),
+                                                                           in_flags="\\\n".join([" I= "+ x for x in inputs]))
+                                                              for output, inputs in self.merges()])
                            )
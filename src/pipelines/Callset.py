@@ -1,5 +1,7 @@
 import os,sys, json
+from collections import defaultdict
 import time,math
+import hashlib
 import logging
 logger = logging.getLogger('luigi-interface')
 alloc_log = logging.getLogger('alloc_log')
@@ -12,8 +14,8 @@ from luigi.util import requires, inherits
 from luigi import LocalTarget
 from luigi.file import TemporaryFile
 
-from src.utils import CheckTargetNonEmpty
-from src.SGUtils import ScatterBED, GatherVCF, ScatterVCF
+from src.utils import CheckTargetNonEmpty, ModelledResources, gvcf_path
+from src.SGUtils import ScatterBED, GatherVCF, ScatterVCF, ScatterVCFRegions, VirtualShard, TimedShard, scatter_width
 
 picard="java -XX:+UseSerialGC -Xmx{mem}M -jar /tgac/software/testing/picardtools/2.1.1/x86_64/bin/picard.jar"
 gatk="java -XX:+UseSerialGC -Xmx{mem}M -jar /tgac/software/testing/gatk/3.6.0/x86_64/bin/GenomeAnalysisTK.jar "
@@ -36,7 +38,66 @@ Notes
 job.mem is actually mem_per_cpu
 '''
 
-N_scatter = int(sys.argv[2]) if __name__ == '__main__' else 5
+reference = '/tgac/workarea/collaborators/saunderslab/Realignment/data/PST130_contigs.fasta'
+mask = '/tgac/workarea/users/buntingd/realignment/PST130/Combined/PST130_RNASeq_collapsed_exons.bed'
+
+def interval_length(bed):
+    with open(bed, 'r') as f:
+        return sum([int(l.split()[2]) - int(l.split()[1]) for l in f if l.strip()])
+
+def reference_length(reference):
+    with open(reference + '.fai', 'r') as f:
+        return sum([int(l.split()[1]) for l in f if l.strip()])
+
+def cli_arg(flag, default=None):
+    '''Value of ``flag`` in the arguments passed through to luigi.run, or ``default``'''
+    args = sys.argv[3:]
+    return args[args.index(flag) + 1] if flag in args[:-1] else default
+
+# Callset written by the task each scattered family reads its input from, None for the GVCFs
+scatter_inputs = {'GenotypeGVCF':None, 'VcfToolsFilter':'_raw', 'FilterCallset':'_raw',
+                  'GetSNPs':'_filtered', 'GetINDELs':'_filtered', 'GetRefSNPs':'_filtered'}
+
+def scatter_work(family, lib_list, base_dir, output_prefix, mask, reference):
+    '''Work units of ``family`` over the callset, as the bytes of its input inside ``mask``. The GVCFs
+    cover the whole reference so are scaled by the fraction of it in the mask. A callset that has not
+    been written yet is estimated from the GVCFs'''
+    gvcfs = [gvcf_path(base_dir, library) for library in lib_list]
+    in_mask = interval_length(mask)/reference_length(reference)
+    estimate = sum([os.path.getsize(x) for x in gvcfs if os.path.exists(x)])*in_mask
+    if scatter_inputs[family] is None:
+        return estimate
+    callset = os.path.join(base_dir, 'callsets', output_prefix, output_prefix + scatter_inputs[family] + ".vcf.gz")
+    return os.path.getsize(callset) if os.path.exists(callset) else estimate
+
+# ScatterGather fixes the number of shards when the classes are defined, so when run with N_scatter
+# 'auto' the width of each task family is chosen here from the size of its input and past runtimes,
+# taking the mask, reference and base_dir from the command line where they are given
+if __name__ == '__main__' and sys.argv[2] == 'auto':
+    with open(sys.argv[1], 'r') as libs_file:
+        auto_libs = [line.rstrip() for line in libs_file if line.strip()]
+    auto_base_dir = cli_arg('--base-dir', luigi.configuration.get_config().get('CallsetWrapper', 'base_dir', None))
+    auto_args = (auto_libs, auto_base_dir, os.path.split(sys.argv[1])[1].split('.', 1)[0],
+                 cli_arg('--mask', mask), cli_arg('--reference', reference))
+    N_scatter = dict([(family, scatter_width(family, scatter_work(family, *auto_args) if auto_base_dir else 0))
+                      for family in scatter_inputs])
+else:
+    N = int(sys.argv[2]) if __name__ == '__main__' else 5
+    N_scatter = defaultdict(lambda: N)
+
+# Set virtual=true in the [scatter] section of luigi.cfg to scatter the VCF stages by tabix regions
+# rather than rewriting the callset into shards
+VCFScatter = ScatterVCFRegions if luigi.configuration.get_config().getboolean('scatter', 'virtual', False) else ScatterVCF
+
+# Outputs of GetSNPs, GetINDELs and GetRefSNPs by their select_variants.py option, as written by FilterCallset
+SELECTIONS = {'snps':'SNPs', 'indels':'INDELs_only', 'ref_snps':'RefSNPs'}
+
+def selection_path(path, selection):
+    '''Path of ``selection`` written beside the filtered VCF ``path``'''
+    base = path[:-len('.vcf.gz')]
+    if base.endswith('_filtered'):
+        base = base[:-len('_filtered')]
+    return base + '_' + SELECTIONS[selection] + '.vcf.gz'
 
 class GenomeContigs(luigi.ExternalTask):
     '''one per line list of contigs in the genome'''
@@ -44,18 +105,90 @@ class GenomeContigs(luigi.ExternalTask):
     def output(self):
         return LocalTarget(self.mask)
 
-@ScatterGather(ScatterBED, GatherVCF, N_scatter)
+def combine_slices(libraries, k):
+    '''Split ``libraries`` into the slices combined by the children of a CombineGVCFs node over them.
+    Slices hold the largest power of k that is less than the number of libraries, aligned to multiples of it,
+    so appending a library only changes the last slice at each level of the tree'''
+    cap = 1
+    while cap*k < len(libraries):
+        cap *= k
+    return [libraries[i:i+cap] for i in range(0, len(libraries), cap)]
+
+class CombineGVCFs(ModelledResources, SlurmExecutableTask, CheckTargetNonEmpty):
+    '''Node of a tree of CombineGVCFs merging the per library GVCFs in batches of ``combine_batch``.
+    Outputs are named by a hash of the libraries and mask, so they are shared between callsets and
+    re-used when libraries are appended
+    :param list libraries: Libraries to combine, in order
+    :param int combine_batch: Maximum number of GVCFs combined by one node'''
+    libraries = luigi.ListParameter()
+    combine_batch = luigi.IntParameter()
+    base_dir = luigi.Parameter(significant=False)
+    reference = luigi.Parameter()
+    mask = luigi.Parameter()
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Set the SLURM request params for this task
+        self.mem = 8000
+        self.n_cpu = 1
+        self.partition = "tgac-medium"
+        
+    def children(self):
+        return combine_slices(list(self.libraries), self.combine_batch)
+        
+    def requires(self):
+        return [self.clone(CombineGVCFs, libraries=x) for x in self.children() if len(x) > 1]
+        
+    def output(self):
+        key = hashlib.sha1(json.dumps([list(self.libraries), self.mask]).encode()).hexdigest()[:12]
+        name = "{0}-{1}_{2}_{3}.g.vcf.gz".format(self.libraries[0], self.libraries[-1], len(self.libraries), key)
+        return LocalTarget(os.path.join(self.base_dir, 'callsets', 'combined', name))
+        
+    def work_script(self):
+        return '''#!/bin/bash
+                source jre-8u92
+                source gatk-3.6.0
+                gatk='{gatk}'
+                
+                set -eo pipefail
+                mkdir -p {dir}
+                $gatk -T CombineGVCFs -R {reference} -L {mask} -o {output}.temp.g.vcf.gz {variants}
+                
+                mv {output}.temp.g.vcf.gz.tbi {output}.tbi
+                mv {output}.temp.g.vcf.gz {output}
+                '''.format(output=self.output().path,
+                           dir=os.path.dirname(self.output().path),
+                           gatk=gatk.format(mem=self.mem*self.n_cpu),
+                           reference=self.reference,
+                           mask=self.mask,
+                           variants="\\\n".join([" --variant "+ x for x in combined_gvcfs(self, self.children())]))
+
+def combined_gvcfs(task, slices):
+    '''The GVCF of each slice of libraries, from CombineGVCFs unless the slice is a single library'''
+    return [gvcf_path(task.base_dir, x[0]) if len(x) == 1 else task.clone(CombineGVCFs, libraries=x).output().path
+            for x in slices]
+
+@ScatterGather(ScatterBED, GatherVCF, N_scatter['GenotypeGVCF'])
 @inherits(GenomeContigs)
-class GenotypeGVCF(SlurmExecutableTask, CheckTargetNonEmpty):
+class GenotypeGVCF(TimedShard, ModelledResources, SlurmExecutableTask, CheckTargetNonEmpty):
     '''Combine the per sample g.vcfs into a complete callset
-    :param str output_prefix: '''
+    :param str output_prefix:
+    :param int combine_batch: If more libraries than this, first merge their GVCFs with a tree of
+        CombineGVCFs in batches of this size. 0 passes every GVCF straight to GenotypeGVCFs
+    :param bool incremental: Genotype each shard from a persistent combined GVCF of its intervals
+        that only has new libraries appended, see incremental_work_script'''
     output_prefix = luigi.Parameter()
     base_dir = luigi.Parameter(significant=False)
     scratch_dir = luigi.Parameter(default="/tgac/scratch/buntingd/", significant=False)
     reference = luigi.Parameter()
     lib_list = luigi.ListParameter()        
+    combine_batch = luigi.IntParameter(default=0, significant=False)
+    incremental = luigi.BoolParameter(default=False, significant=False)
     
     def requires(self):
+        if self.combined():
+            return {'intervals':self.clone(GenomeContigs),
+                    'gvcfs':[self.clone(CombineGVCFs, libraries=x) for x in self.combined() if len(x) > 1]}
         return self.clone(GenomeContigs)
         
     def __init__(self, *args, **kwargs):
@@ -64,12 +197,23 @@ class GenotypeGVCF(SlurmExecutableTask, CheckTargetNonEmpty):
         self.mem = 8000
         self.n_cpu = 1
         self.partition = "tgac-medium"
-        self.variants = [os.path.join(self.base_dir, 'libraries', library, library + ".g.vcf") for library in self.lib_list]
+        if self.combined():
+            self.variants = combined_gvcfs(self, self.combined())
+        else:
+            self.variants = [gvcf_path(self.base_dir, library) for library in self.lib_list]
+            
+    def combined(self):
+        '''Slices of lib_list each combined into one GVCF, or None if not combining'''
+        if self.combine_batch > 1 and len(self.lib_list) > self.combine_batch and not self.incremental:
+            return combine_slices(list(self.lib_list), self.combine_batch)
+        return None
 
     def output(self):
         return LocalTarget(os.path.join(self.base_dir, 'callsets', self.output_prefix, self.output_prefix+"_raw.vcf.gz"))
     
     def work_script(self):
+        if self.incremental:
+            return self.incremental_work_script()
         return '''#!/bin/bash
                 source jre-8u92
                 source gatk-3.6.0
@@ -85,13 +229,135 @@ class GenotypeGVCF(SlurmExecutableTask, CheckTargetNonEmpty):
                            reference=self.reference,
                            variants="\\\n".join([" --variant "+ lib for lib in self.variants]) )
 
-@ScatterGather(ScatterVCF, GatherVCF, N_scatter)
+    def store_dir(self):
+        '''Persistent store for this shard, keyed by its intervals and the reference'''
+        sha = hashlib.sha1(self.reference.encode())
+        with open(self.input().path, 'rb') as f:
+            sha.update(f.read())
+        return os.path.join(self.base_dir, 'callsets', 'store', sha.hexdigest()[:16])
+
+    def members(self):
+        '''Sorted library, GVCF path, size and mtime of each GVCF, so a regenerated GVCF is a different member'''
+        members = []
+        for lib in self.lib_list:
+            path = gvcf_path(self.base_dir, lib)
+            st = os.stat(path)
+            members.append("\t".join([lib, path, str(st.st_size), str(int(st.st_mtime))]))
+        return sorted(members)
+
+    def incremental_work_script(self):
+        '''The shard store holds combined.g.vcf.gz of the GVCFs in members.tsv over the shard intervals.
+        GVCFs not yet in the store are appended to it with CombineGVCFs, it is only rebuilt if a library
+        has been removed or its GVCF has changed. The shard genotyped for the latest members is kept in the
+        store so is only recomputed when they change. The store is locked while it is updated'''
+        members = self.members()
+        members_key = hashlib.sha1("\n".join(members).encode()).hexdigest()[:16]
+        # Written here rather than by the script so the paths go through no shell quoting or printf formats
+        os.makedirs(os.path.dirname(self.output().path), exist_ok=True)
+        with open(self.output().path + '.members', 'w') as f:
+            f.writelines([x + "\n" for x in members])
+        return '''#!/bin/bash
+                source jre-8u92
+                source gatk-3.6.0
+                gatk='{gatk}'
+
+                set -eo pipefail
+                export LC_ALL=C
+                store={store}
+                mkdir -p $store
+                exec 9> $store/.lock
+                flock 9
+
+                sort -o {output}.members {output}.members
+                if [ ! -e $store/members.tsv ]; then
+                    # A store from before members were tracked can't be trusted
+                    rm -f $store/combined.g.vcf.gz $store/combined.g.vcf.gz.tbi $store/libraries.txt
+                    touch $store/members.tsv
+                fi
+
+                if [ ! -s $store/genotyped_{members_key}.vcf.gz ]; then
+                    if comm -23 $store/members.tsv {output}.members | grep -q .; then
+                        echo "Libraries removed or their GVCFs changed, rebuilding $store"
+                        rm -f $store/combined.g.vcf.gz $store/combined.g.vcf.gz.tbi
+                        > $store/members.tsv
+                    fi
+
+                    new=$(comm -13 $store/members.tsv {output}.members | cut -f2 | sed 's/^/--variant /')
+                    if [ -n "$new" ]; then
+                        echo "Appending $(echo "$new" | wc -l) libraries to $store"
+                        old=""
+                        if [ -s $store/combined.g.vcf.gz ]; then old="--variant $store/combined.g.vcf.gz"; fi
+                        $gatk -T CombineGVCFs -R {reference} -L {intervals} -o $store/combined.temp.g.vcf.gz $old $new
+                        mv $store/combined.temp.g.vcf.gz.tbi $store/combined.g.vcf.gz.tbi
+                        mv $store/combined.temp.g.vcf.gz $store/combined.g.vcf.gz
+                        cp {output}.members $store/members.tsv
+                    fi
+
+                    $gatk -T GenotypeGVCFs -R {reference} -L {intervals} -o $store/genotyped_{members_key}.temp.vcf.gz --includeNonVariantSites --variant $store/combined.g.vcf.gz
+                    mv $store/genotyped_{members_key}.temp.vcf.gz.tbi $store/genotyped_{members_key}.vcf.gz.tbi
+                    mv $store/genotyped_{members_key}.temp.vcf.gz $store/genotyped_{members_key}.vcf.gz
+                    # Only the shard genotyped for the current members is worth keeping
+                    find $store -maxdepth 1 -name 'genotyped_*' ! -name 'genotyped_{members_key}.vcf.gz*' -delete
+                else
+                    echo "Shard already genotyped for these GVCFs in $store"
+                fi
+
+                cp $store/genotyped_{members_key}.vcf.gz {output}.temp.vcf.gz
+                rm {output}.members
+                mv {output}.temp.vcf.gz {output}
+                '''.format(output=self.output().path,
+                           store=self.store_dir(),
+                           intervals=self.input().path,
+                           gatk=gatk.format(mem=self.mem*self.n_cpu),
+                           reference=self.reference,
+                           members_key=members_key)
+
+class HardFilter(VirtualShard):
+    '''Hard filtering of a shard of the raw callset, shared by VcfToolsFilter and FilterCallset'''
+    def filter_script(self):
+        '''bash that hard filters the shard, the last command writes the VCF to stdout so it can be piped on'''
+        vcf, regions = self.shard_input()
+        if self.streaming:
+            return self.streaming_filter_script(vcf, regions)
+            
+        self.temp1 = TemporaryFile()
+        self.temp2 = TemporaryFile()
+        return '''bcftools view --apply-filters . {regions} {input} -o {temp1} -O z --threads 1
+                bcftools filter {temp1} -e "{expr}" --set-GTs . -o {temp2} -O z --threads 1
+                vcftools --gzvcf {temp2} --recode --max-missing 0.000001 --stdout --bed {mask}'''.format(
+                           input=vcf,
+                           regions=self.region_flags(regions),
+                           expr=self.filter_expr(),
+                           mask=self.mask,
+                           temp1=self.temp1.path,
+                           temp2=self.temp2.path)
+    
+    def streaming_filter_script(self, vcf, regions):
+        '''As filter_script but the stages are connected by uncompressed BCF/VCF pipes instead of bgzipped
+        temporaries. Each stage reports its elapsed and CPU time to stderr'''
+        return '''( TIMEFORMAT="bcftools view: %R s elapsed, %U s user, %S s sys"
+                  time bcftools view --apply-filters . {regions} {input} -O u ) |
+                ( TIMEFORMAT="bcftools filter: %R s elapsed, %U s user, %S s sys"
+                  time bcftools filter - -e "{expr}" --set-GTs . -O v ) |
+                ( TIMEFORMAT="vcftools: %R s elapsed, %U s user, %S s sys"
+                  time vcftools --vcf - --recode --max-missing 0.000001 --stdout --bed {mask} )'''.format(
+                           input=vcf,
+                           regions=self.region_flags(regions),
+                           expr=self.filter_expr(),
+                           mask=self.mask)
+    
+    def filter_expr(self):
+        return "FMT/RGQ < {GQ} || FMT/GQ < {GQ} || QD < {QD} || FS > {FS}".format(GQ=self.GQ, QD=self.QD, FS=self.FS)
+
+@ScatterGather(VCFScatter, GatherVCF, N_scatter['VcfToolsFilter'])
 @inherits(GenotypeGVCF)
-class VcfToolsFilter(SlurmExecutableTask, CheckTargetNonEmpty):
-    '''Applies hard filtering to the raw callset'''
+class VcfToolsFilter(TimedShard, HardFilter, ModelledResources, SlurmExecutableTask, CheckTargetNonEmpty):
+    '''Applies hard filtering to the raw callset
+    :param bool streaming: Pipe the filtering stages together uncompressed rather than through bgzipped temporaries'''
     GQ = luigi.IntParameter(default=30)
     QD = luigi.IntParameter(default=5)
     FS = luigi.IntParameter(default=30)
+    streaming = luigi.BoolParameter(default=False, significant=False)
     
     def requires(self):
         return self.clone(GenotypeGVCF)
@@ -107,32 +373,86 @@ class VcfToolsFilter(SlurmExecutableTask, CheckTargetNonEmpty):
         return LocalTarget(os.path.join(self.base_dir, 'callsets', self.output_prefix , self.output_prefix + "_filtered.vcf.gz"))
     
     def work_script(self):
-        self.temp1 = TemporaryFile()
-        self.temp2 = TemporaryFile()
-        
+        vcf, regions = self.shard_input()
+        if self.empty_shard(regions):
+            return self.empty_shard_script(vcf, [self.output().path])
         return '''#!/bin/bash
                 source vcftools-0.1.13;
                 source bcftools-1.3.1;
                 set -eo pipefail
                 
-                bcftools view --apply-filters . {input} -o {temp1} -O z --threads 1
-                bcftools filter {temp1} -e "FMT/RGQ < {GQ} || FMT/GQ < {GQ} || QD < {QD} || FS > {FS}" --set-GTs . -o {temp2} -O z --threads 1
-                vcftools --gzvcf {temp2} --recode --max-missing 0.000001 --stdout --bed {mask} | bgzip -c > {output}.temp
+                {filter_script} | {bgzip} > {output}.temp
                 
                 mv {output}.temp {output}
                 tabix -p vcf {output}
-                '''.format(input=self.input().path,
-                           output=self.output().path,
-                           GQ=self.GQ,
-                           QD=self.QD,
-                           FS=self.FS,
-                           mask=self.mask,
-                           temp1=self.temp1.path,
-                           temp2=self.temp2.path)
+                '''.format(filter_script=self.filter_script(),
+                           bgzip=self.bgzip_script(),
+                           output=self.output().path)
+    
+    def bgzip_script(self):
+        '''bgzip of the filtered VCF. When streaming it is timed and threaded, if the bgzip on the path
+        is from htslib 1.4 or later and so takes -@'''
+        if not self.streaming:
+            return "bgzip -c"
+        return '''( TIMEFORMAT="bgzip: %R s elapsed, %U s user, %S s sys"
+                  if grep -q -- '--threads' <(bgzip -h 2>&1); then time bgzip -c -@ {n_cpu}; else time bgzip -c; fi )'''.format(
+                           n_cpu=self.n_cpu)
 
-@ScatterGather(ScatterVCF, GatherVCF, N_scatter)
+class GatherFilteredCallset(GatherVCF):
+    '''Gathers the filtered callset and the selections FilterCallset writes beside each shard'''
+    def merges(self):
+        inputs = [x.path for x in self.input()]
+        return ([(selection_path(self.output().path, s), [selection_path(x, s) for x in inputs]) for s in sorted(SELECTIONS)] +
+                super().merges())
+
+@ScatterGather(VCFScatter, GatherFilteredCallset, N_scatter['FilterCallset'])
 @inherits(VcfToolsFilter)
-class GetSNPs(SlurmExecutableTask, CheckTargetNonEmpty):
+class FilterCallset(TimedShard, HardFilter, ModelledResources, SlurmExecutableTask, CheckTargetNonEmpty):
+    '''Fused VcfToolsFilter, GetSNPs, GetINDELs and GetRefSNPs. Each shard is filtered and split into
+    the SNP, INDEL and RefSNP selections in a single pass, written to the outputs of those tasks'''
+    def requires(self):
+        return self.clone(GenotypeGVCF)
+        
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Set the SLURM request params for this task
+        self.mem = 8000
+        self.n_cpu = 2
+        self.partition = "tgac-medium"
+        
+    def output(self):
+        return LocalTarget(os.path.join(self.base_dir, 'callsets', self.output_prefix , self.output_prefix + "_filtered.vcf.gz"))
+    
+    def complete(self):
+        # The filtered VCF alone may have been left by VcfToolsFilter
+        return super().complete() and all([os.path.exists(selection_path(self.output().path, s)) for s in SELECTIONS])
+    
+    def work_script(self):
+        output = self.output().path
+        vcf, regions = self.shard_input()
+        if self.empty_shard(regions):
+            return self.empty_shard_script(vcf, [selection_path(output, x) for x in sorted(SELECTIONS)] + [output])
+        return '''#!/bin/bash
+                source vcftools-0.1.13;
+                source bcftools-1.3.1;
+                {python}
+                set -eo pipefail
+                
+                {filter_script} | python {script_dir}/select_variants.py --threads {n_cpu} {output}.temp.vcf.gz {selections}
+                
+                {mv}
+                '''.format(python=python,
+                           filter_script=self.filter_script(),
+                           script_dir=script_dir,
+                           n_cpu=self.n_cpu,
+                           output=output,
+                           selections=" ".join(["--{0} {1}.temp.vcf.gz".format(s.replace('_', '-'), selection_path(output, s)) for s in sorted(SELECTIONS)]),
+                           mv="\n                ".join(["mv {0}.temp.vcf.gz.tbi {0}.tbi && mv {0}.temp.vcf.gz {0}".format(x)
+                                                          for x in [selection_path(output, s) for s in sorted(SELECTIONS)] + [output]]))
+
+@ScatterGather(VCFScatter, GatherVCF, N_scatter['GetSNPs'])
+@inherits(VcfToolsFilter)
+class GetSNPs(TimedShard, VirtualShard, ModelledResources, SlurmExecutableTask, CheckTargetNonEmpty):
     '''Extracts just sites with only biallelic SNPs that have a least one variant isolate'''
     def requires(self):
         return self.clone(VcfToolsFilter)
@@ -148,23 +468,27 @@ class GetSNPs(SlurmExecutableTask, CheckTargetNonEmpty):
         return LocalTarget(os.path.join(self.base_dir, 'callsets', self.output_prefix , self.output_prefix + "_SNPs.vcf.gz"))
         
     def work_script(self):
+        vcf, regions = self.shard_input()
+        if self.empty_shard(regions):
+            return self.empty_shard_script(vcf, [self.output().path])
         return '''#!/bin/bash
                   source jre-8u92
                   source gatk-3.6.0
                   gatk='{gatk}'
                   set -eo pipefail
                   
-                  $gatk -T -T SelectVariants -V {input} -R {reference} --restrictAllelesTo BIALLELIC --selectTypeToInclude SNP --out {output}.temp.vcf.gz
+                  $gatk -T -T SelectVariants -V {input} {regions} -R {reference} --restrictAllelesTo BIALLELIC --selectTypeToInclude SNP --out {output}.temp.vcf.gz
                   
                   mv {output}.temp.vcf.gz {output}
-                  '''.format(input=self.input().path,
+                  '''.format(input=vcf,
+                             regions=self.region_flags(regions, 'gatk'),
                              output=self.output().path,
                              reference=self.reference,
                              gatk=gatk.format(mem=self.mem*self.n_cpu))
 
-@ScatterGather(ScatterVCF, GatherVCF, N_scatter)
+@ScatterGather(VCFScatter, GatherVCF, N_scatter['GetINDELs'])
 @inherits(VcfToolsFilter)
-class GetINDELs(SlurmExecutableTask, CheckTargetNonEmpty):
+class GetINDELs(TimedShard, VirtualShard, ModelledResources, SlurmExecutableTask, CheckTargetNonEmpty):
     '''Get sites with MNPs'''
     def requires(self):
         return self.clone(VcfToolsFilter)
@@ -180,23 +504,27 @@ class GetINDELs(SlurmExecutableTask, CheckTargetNonEmpty):
         return LocalTarget(os.path.join(self.base_dir, 'callsets', self.output_prefix , self.output_prefix + "_INDELs_only.vcf.gz"))
         
     def work_script(self):
+        vcf, regions = self.shard_input()
+        if self.empty_shard(regions):
+            return self.empty_shard_script(vcf, [self.output().path])
         return '''#!/bin/bash
                   source jre-8u92
                   source gatk-3.6.0
                   gatk='{gatk}'
                   set -eo pipefail
                   
-                  $gatk -T -T SelectVariants -V {input} -R {reference} --selectTypeToInclude MNP  --selectTypeToInclude MIXED   --out {output}.temp.vcf.gz
+                  $gatk -T -T SelectVariants -V {input} {regions} -R {reference} --selectTypeToInclude MNP  --selectTypeToInclude MIXED   --out {output}.temp.vcf.gz
                   
                   mv {output}.temp.vcf.gz {output}
-                  '''.format(input=self.input().path,
+                  '''.format(input=vcf,
+                             regions=self.region_flags(regions, 'gatk'),
                              output=self.output().path,
                              reference=self.reference,
                              gatk=gatk.format(mem=self.mem*self.n_cpu))
 
-@ScatterGather(ScatterVCF, GatherVCF, N_scatter)
+@ScatterGather(VCFScatter, GatherVCF, N_scatter['GetRefSNPs'])
 @inherits(VcfToolsFilter)
-class GetRefSNPs(SlurmExecutableTask, CheckTargetNonEmpty):
+class GetRefSNPs(TimedShard, VirtualShard, ModelledResources, SlurmExecutableTask, CheckTargetNonEmpty):
     '''Create a VCF with SNPs and include sites that are reference like in all samples'''
     def requires(self):
         return self.clone(VcfToolsFilter)
@@ -211,16 +539,20 @@ class GetRefSNPs(SlurmExecutableTask, CheckTargetNonEmpty):
         return LocalTarget(os.path.join(self.base_dir, 'callsets', self.output_prefix , self.output_prefix + "_RefSNPs.vcf.gz"))
         
     def work_script(self):
+        vcf, regions = self.shard_input()
+        if self.empty_shard(regions):
+            return self.empty_shard_script(vcf, [self.output().path])
         return '''#!/bin/bash
                   source jre-8u92
                   source gatk-3.6.0
                   gatk='{gatk}'
                   set -eo pipefail
                   
-                  $gatk -T -T SelectVariants -V {input} -R {reference} --restrictAllelesTo BIALLELIC --selectTypeToInclude SYMBOLIC --selectTypeToInclude NO_VARIATION  --selectTypeToInclude SNP  --out {output}.temp.vcf.gz
+                  $gatk -T -T SelectVariants -V {input} {regions} -R {reference} --restrictAllelesTo BIALLELIC --selectTypeToInclude SYMBOLIC --selectTypeToInclude NO_VARIATION  --selectTypeToInclude SNP  --out {output}.temp.vcf.gz
                   
                   mv {output}.temp.vcf.gz {output}
-                  '''.format(input=self.input().path,
+                  '''.format(input=vcf,
+                             regions=self.region_flags(regions, 'gatk'),
                              output=self.output().path,
                              reference=self.reference,
                              gatk=gatk.format(mem=self.mem*self.n_cpu))
@@ -231,10 +563,17 @@ class GetRefSNPs(SlurmExecutableTask, CheckTargetNonEmpty):
 @inherits(GetRefSNPs)
 @inherits(GetINDELs)
 class CallsetWrapper(luigi.WrapperTask):
+    '''
+    :param bool fused: Filter and select the SNPs, INDELs and RefSNPs in one pass per shard with FilterCallset'''
+    fused = luigi.BoolParameter(default=False, significant=False)
+    
     def requires(self):
-        yield self.clone(GetINDELs)
-        yield self.clone(GetSNPs)
-        yield self.clone(GetRefSNPs)
+        if self.fused:
+            yield self.clone(FilterCallset)
+        else:
+            yield self.clone(GetINDELs)
+            yield self.clone(GetSNPs)
+            yield self.clone(GetRefSNPs)
 
 if __name__ == '__main__':
     os.environ['TMPDIR'] = "/tgac/scratch/buntingd"
@@ -260,5 +599,5 @@ if __name__ == '__main__':
     
     luigi.run(['CallsetWrapper', '--output-prefix', name,
                                  '--lib-list', json.dumps(lib_list),
-                                 '--reference', '/tgac/workarea/collaborators/saunderslab/Realignment/data/PST130_contigs.fasta',
-                                 '--mask', '/tgac/workarea/users/buntingd/realignment/PST130/Combined/PST130_RNASeq_collapsed_exons.bed'] + sys.argv[3:])
+                                 '--reference', reference,
+                                 '--mask', mask] + sys.argv[3:])
@@ -1,4 +1,7 @@
 import os,sys, json,shutil
+import math
+import hashlib
+import subprocess
 import multiprocessing
 from time import sleep
 import time
@@ -12,11 +15,14 @@ alloc_log.setLevel(logging.DEBUG)
 import luigi
 from luigi.contrib import sqla
 from luigi.contrib.slurm import SlurmExecutableTask
+from luigi.contrib.scattergather import ScatterGather
 from luigi.util import requires, inherits
 from luigi import LocalTarget
 from luigi.file import TemporaryFile
 
-from src.utils import CheckTargetNonEmpty
+from src.utils import CheckTargetNonEmpty, PrefetchedComplete, ModelledResources, has_read_group
+from src.SGUtils import ScatterBED, GatherVCF
+from src.scripts.fetch_fastq import sources_unchanged
 import src.utils as utils
 
 picard="java -XX:+UseSerialGC -Xmx{mem}M -jar /tgac/software/testing/picardtools/2.1.1/x86_64/bin/picard.jar"
@@ -24,6 +30,10 @@ gatk="java -XX:+UseSerialGC -Xmx{mem}M -jar /tgac/software/testing/gatk/3.6.0/x8
 trimmomatic="java -XX:+UseSerialGC -Xmx{mem}M -jar /tgac/software/testing/trimmomatic/0.36/x86_64/bin/trimmomatic-0.36.jar "
 python="source /usr/users/ga004/buntingd/FP_dev/dev/bin/activate"
 
+# Set haplotype_caller=N in the [scatter] section of luigi.cfg to run HaplotypeCaller for each library
+# as N jobs over shards of the reference contigs, gathered into the library GVCF
+hc_scatter = luigi.configuration.get_config().getint('scatter', 'haplotype_caller', 1)
+
 # Ugly hack
 script_dir = os.path.join(os.path.split(os.path.split(__file__)[0])[0], 'scripts')
 log_dir = os.path.join(os.path.split(os.path.split(os.path.split(__file__)[0])[0])[0], 'logs')
@@ -44,14 +54,17 @@ Notes
 job.mem is actually mem_per_cpu
 '''
 
-class FetchFastqGZ(CheckTargetNonEmpty, SlurmExecutableTask):
-    '''Fetches and concatenate the fastq.gz files for ``library`` from the /reads/ server
+class FetchFastqGZ(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
+    '''Fetches and concatenate the fastq.gz files for ``library`` from the /reads/ server.
+     The lanes are copied concurrently and a manifest of their sizes and mtimes is kept
+     alongside the output, so the fetch is rerun only if the sources change
      :param str library: library name  '''
     
     library = luigi.Parameter()
     base_dir = luigi.Parameter(significant=False)
     scratch_dir = luigi.Parameter(default="/tgac/scratch/buntingd/", significant=False)
     read_dir = luigi.Parameter(default="/tgac/data/reads/*DianeSaunders*", significant=False)
+    fetch_threads = luigi.IntParameter(default=4, significant=False)
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -59,28 +72,45 @@ class FetchFastqGZ(CheckTargetNonEmpty, SlurmExecutableTask):
         self.mem = 1000
         self.n_cpu = 1
         self.partition = "tgac-medium"
+        self.manifest = os.path.join(self.scratch_dir, self.library, "raw_manifest.json")
+        self._sources_unchanged = False
         
     def output(self):
         LocalTarget(os.path.join(self.scratch_dir, self.library, "raw_R1.fastq.gz")).makedirs()
         return [LocalTarget(os.path.join(self.scratch_dir, self.library, "raw_R1.fastq.gz")),
                 LocalTarget(os.path.join(self.scratch_dir, self.library, "raw_R2.fastq.gz"))]
     
+    def complete(self):
+        # Outputs fetched before the manifest existed are trusted as is. The sources are only searched
+        # until they are found unchanged once, rather than on every poll of the scheduler
+        if super().complete():
+            if not self._sources_unchanged:
+                self._sources_unchanged = (not os.path.exists(self.manifest) or
+                                           sources_unchanged(self.manifest, self.read_dir))
+            return self._sources_unchanged
+        return False
+    
     def work_script(self):
         return '''#!/bin/bash -e 
+                  {python}
                   set -euo pipefail
                   
-                  find {read_dir} -name "*{library}*_R1.fastq.gz" -type f  -print | sort | xargs cat  > {R1}.temp
-                  find {read_dir} -name "*{library}*_R2.fastq.gz" -type f  -print | sort | xargs cat  > {R2}.temp
-                  
-                  mv {R1}.temp {R1}
-                  mv {R2}.temp {R2}
-                 '''.format(read_dir = self.read_dir,
+                  python {script_dir}/fetch_fastq.py --threads {threads} "{read_dir}" {library} {R1} {R2} {manifest}
+                 '''.format(python=python,
+                            script_dir=script_dir,
+                            threads=self.fetch_threads,
+                            read_dir = self.read_dir,
                             library=self.library,
+                            manifest=self.manifest,
                             R1=self.output()[0].path,
                             R2=self.output()[1].path)  
 
 @requires(FetchFastqGZ)
-class Trimmomatic(CheckTargetNonEmpty, SlurmExecutableTask):
+class Trimmomatic(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
+    ''':param bool fused_qc: Compute the FastxQC stats while decompressing the raw reads for Trimmomatic,
+    so they are only decompressed once'''
+    fused_qc = luigi.BoolParameter(default=False, significant=False)
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
@@ -92,6 +122,8 @@ class Trimmomatic(CheckTargetNonEmpty, SlurmExecutableTask):
         return [LocalTarget(os.path.join(self.scratch_dir, self.library, "filtered_R1.fastq.gz")),
                 LocalTarget(os.path.join(self.scratch_dir, self.library, "filtered_R2.fastq.gz"))]
     def work_script(self):
+        if self.fused_qc:
+            return self.fused_work_script()
         return '''#!/bin/bash
                source jre-8u92
                source trimmomatic-0.30
@@ -116,16 +148,58 @@ class Trimmomatic(CheckTargetNonEmpty, SlurmExecutableTask):
                            adapters='/tgac/software/testing/trimmomatic/0.30/x86_64/bin/adapters/TruSeq.cat.fa',
                            R1_out=self.output()[0].path,
                            R2_out=self.output()[1].path)
+                           
+    def fused_work_script(self):
+        '''Trimmomatic reads the raw fastq through fifos fed by fastq_qc.py, which builds the QC stats as it decompresses'''
+        return '''#!/bin/bash
+               source jre-8u92
+               source trimmomatic-0.30
+               {python}
+               set -euo pipefail
+               
+               cd {scratch_dir}
+               trimmomatic='{trimmomatic}'
+               rm -f qc_tee_R1.fastq qc_tee_R2.fastq
+               mkfifo qc_tee_R1.fastq qc_tee_R2.fastq
+               
+               python {script_dir}/fastq_qc.py {R1_in} {R2_in} {qc_prefix} --tee qc_tee_R1.fastq qc_tee_R2.fastq &
+               qc_pid=$!
+               
+               $trimmomatic PE -threads 8 -phred33 qc_tee_R1.fastq qc_tee_R2.fastq -baseout temp.fastq.gz  ILLUMINACLIP:{adapters}:2:30:10:4 SLIDINGWINDOW:4:20 MINLEN:50
+               wait $qc_pid
+               rm qc_tee_R1.fastq qc_tee_R2.fastq
+               
+               mv temp_1P.fastq.gz {R1_out}
+               mv temp_2P.fastq.gz {R2_out}
+               
+                '''.format(python=python,
+                           script_dir=script_dir,
+                           scratch_dir=os.path.join(self.scratch_dir, self.library),
+                           trimmomatic=trimmomatic.format(mem=self.mem*self.n_cpu),
+                           qc_prefix=os.path.join(self.base_dir, 'libraries', self.library, 'QC', self.library),
+                           R1_in=self.input()[0].path,
+                           R2_in=self.input()[1].path,
+                           adapters='/tgac/software/testing/trimmomatic/0.30/x86_64/bin/adapters/TruSeq.cat.fa',
+                           R1_out=self.output()[0].path,
+                           R2_out=self.output()[1].path)
 
-@requires(FetchFastqGZ)
-class FastxQC(SlurmExecutableTask):
-    '''Runs Fastx toolkit to plot the nucleotide and base call quality score distributions '''
+@inherits(Trimmomatic)
+class FastxQC(PrefetchedComplete, ModelledResources, SlurmExecutableTask):
+    '''Plots the nucleotide and base call quality score distributions in the format of the Fastx toolkit.
+    R1 and R2 are each decompressed once and processed in parallel by fastq_qc.py.
+    With ``fused_qc`` the stats are written by Trimmomatic and this task only runs if they are missing'''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
         self.mem = 2000
-        self.n_cpu = 1
+        self.n_cpu = 2
         self.partition = "tgac-medium"
+        self.qc_from_trimmomatic = False
+    
+    def requires(self):
+        if self.fused_qc:
+            return self.clone(Trimmomatic)
+        return self.clone(FetchFastqGZ)
       
     def output(self):
         working_dir = os.path.join(self.base_dir, 'libraries', self.library)
@@ -137,31 +211,41 @@ class FastxQC(SlurmExecutableTask):
                 'nt_dist_R2': LocalTarget(os.path.join(working_dir, 'QC', self.library + "_R2_nt_distr.png")),
             }
     
+    def on_success(self):
+        if self.qc_from_trimmomatic:
+            luigi.Task.on_success(self)
+        else:
+            SlurmExecutableTask.on_success(self)
+
+    def on_failure(self,e):
+        if self.qc_from_trimmomatic:
+            luigi.Task.on_failure(self, e)
+        else:
+            SlurmExecutableTask.on_failure(self,e)
+            
+    def run(self):
+        self.qc_from_trimmomatic = self.fused_qc and all([x.exists() for x in self.output().values()])
+        if self.qc_from_trimmomatic:
+            logger.info("QC stats for " + self.library + " were computed by Trimmomatic")
+        else:
+            super().run()
+    
     def work_script(self):
+        raw = self.clone(FetchFastqGZ).output()
         return '''#!/bin/bash
-        source fastx_toolkit-0.0.13.2
+        {python}
         set -euo pipefail
         
-        gzip -cd {R1_in} | fastx_quality_stats -o {stats_R1} -Q33
-        gzip -cd {R2_in} | fastx_quality_stats -o {stats_R2} -Q33
+        python {script_dir}/fastq_qc.py {R1_in} {R2_in} {qc_prefix}
 
-        fastq_quality_boxplot_graph.sh -i {stats_R1} -o {boxplot_R1}
-        fastq_quality_boxplot_graph.sh -i {stats_R2} -o {boxplot_R2}
-                
-        fastx_nucleotide_distribution_graph.sh -i {stats_R1} -o {nt_dist_R1}
-        fastx_nucleotide_distribution_graph.sh -i {stats_R2} -o {nt_dist_R2}
-
-        '''.format(R1_in=self.input()[0].path,
-                   R2_in=self.input()[1].path,
-                   stats_R1=self.output()['stats_R1'].path,
-                   stats_R2=self.output()['stats_R2'].path,
-                   boxplot_R1=self.output()['boxplot_R1'].path,
-                   boxplot_R2=self.output()['boxplot_R2'].path,
-                   nt_dist_R1=self.output()['nt_dist_R1'].path,
-                   nt_dist_R2=self.output()['nt_dist_R2'].path)
+        '''.format(python=python,
+                   script_dir=script_dir,
+                   R1_in=raw[0].path,
+                   R2_in=raw[1].path,
+                   qc_prefix=os.path.join(self.base_dir, 'libraries', self.library, 'QC', self.library))
 
 @requires(FetchFastqGZ)
-class FastxTrimmer(CheckTargetNonEmpty,SlurmExecutableTask):
+class FastxTrimmer(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
     '''Uses FastxTrimmer to remove Illumina adaptors and barcodes'''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -189,10 +273,46 @@ class FastxTrimmer(CheckTargetNonEmpty,SlurmExecutableTask):
                    R1_out=self.output()[0].path,
                    R2_out=self.output()[1].path)
 
+def shared_genome_dirs(star_genome, local_scratch, scratch_dir):
+    '''The node local directory tracking the jobs using the shared memory copy of ``star_genome``
+    and the directory listing the nodes it may be loaded on'''
+    key = hashlib.sha1(star_genome.encode()).hexdigest()[:12]
+    return (os.path.join(local_scratch, 'star_genome_' + key),
+            os.path.join(scratch_dir, 'star_genome_' + key + '_nodes'))
+
+def release_genome_script(star_genome, shm_dir):
+    '''Bash to remove the shared memory genome if no running job still uses it. Exits 3 if one does'''
+    return '''if [ -d {shm_dir}/jobs ]; then
+                  (
+                    flock 9
+                    for job in $(ls {shm_dir}/jobs); do
+                        squeue -h -j $job 2>/dev/null | grep -q . || rm -f {shm_dir}/jobs/$job
+                    done
+                    if [ -n "$(ls {shm_dir}/jobs)" ]; then
+                        echo "Shared genome still in use by $(ls {shm_dir}/jobs)"
+                        exit 3
+                    fi
+                    STAR --genomeDir {star_genome} --genomeLoad Remove --outFileNamePrefix {shm_dir}/ || echo "No shared genome loaded"
+                  ) 9> {shm_dir}/.lock
+                  fi'''.format(shm_dir=shm_dir, star_genome=star_genome)
+
 @requires(Trimmomatic)
-class Star(CheckTargetNonEmpty, SlurmExecutableTask):
-    '''Runs STAR to align to the reference :param str star_genome:'''
+class Star(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
+    '''Runs STAR to align to the reference :param str star_genome:
+    :param bool star_read_groups: Set the read group in STAR rather than with AddReadGroups, which
+        passes the BAM straight through when its header has the read group
+    :param str local_scratch: Node local directory for STAR's temporary files, mostly the BAM sorting bins
+    :param bool star_shared_genome: Share one copy of the genome in shared memory between the Star jobs on
+        a node with --genomeLoad LoadAndKeep. Each job registers itself in a node local directory and the
+        last one to finish removes the genome, UnloadStarGenome cleans up after any that were killed
+    :param str star_sort_options: STAR options sizing the BAM sort, formatted with the sort_ram, bins and n_cpu
+        from sort_params. --outBAMsortingBinsN {bins} --outBAMsortingThreadN {n_cpu} can be added for
+        STAR builds that accept them, they are left out by default as star-2.5.0a may not'''
     star_genome = luigi.Parameter()
+    star_read_groups = luigi.BoolParameter(default=False, significant=False)
+    local_scratch = luigi.Parameter(default="/tmp", significant=False)
+    star_shared_genome = luigi.BoolParameter(default=False, significant=False)
+    star_sort_options = luigi.Parameter(default="--limitBAMsortRAM {sort_ram}", significant=False)
     
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -207,15 +327,34 @@ class Star(CheckTargetNonEmpty, SlurmExecutableTask):
             'star_log' : LocalTarget(os.path.join(self.base_dir, 'libraries', self.library, 'Log.final.out'))
         }
     
+    def genome_size(self):
+        '''Bytes of the genome index STAR holds in memory'''
+        return sum([os.path.getsize(os.path.join(self.star_genome, x)) for x in ('Genome', 'SA', 'SAindex')
+                    if os.path.exists(os.path.join(self.star_genome, x))])
+    
+    def sort_params(self):
+        '''Sizes the BAM sort from the SLURM allocation. The sort gets what is left after the genome and
+        1GB for everything else, split into enough bins that each thread's bin fits, taking the BAM to be
+        about the size of the gzipped reads'''
+        alloc = self.mem*self.n_cpu*1024**2
+        sort_ram = max(alloc - self.genome_size() - 1024**3, 256*1024**2)
+        est_bam = sum([os.path.getsize(x.path) for x in self.input() if x.exists()])
+        bins = min(max(math.ceil(2*est_bam*self.n_cpu/sort_ram), 50), 500)
+        return sort_ram, bins
+    
     def work_script(self):
+        sort_ram, bins = self.sort_params()
         return '''#!/bin/bash
                   source star-2.5.0a
                   set -euo pipefail
                   
                   mkdir -p {scratch_dir}/star_temp
                   cd  {scratch_dir}/star_temp
-                  
-                  STAR  --genomeDir {star_genome} --outSAMtype BAM SortedByCoordinate --runThreadN {n_cpu} --readFilesCommand gunzip -c --readFilesIn {R1} {R2}
+                  local_temp=$(mktemp -d {local_scratch}/star_{library}_XXXXXX)
+                  trap "rm -rf $local_temp" EXIT
+                  {shared_genome}
+                  STAR  --genomeDir {star_genome} --outSAMtype BAM SortedByCoordinate --runThreadN {n_cpu} --readFilesCommand gunzip -c --readFilesIn {R1} {R2} {rg_line} \
+                        --outTmpDir $local_temp/STARtmp {sort_options} {genome_load}
                   
                   mv {scratch_dir}/star_temp/Log.final.out {star_log}
                   mv {scratch_dir}/star_temp/Aligned.sortedByCoord.out.bam {star_bam}
@@ -223,10 +362,36 @@ class Star(CheckTargetNonEmpty, SlurmExecutableTask):
                   '''.format(star_bam=self.output()['star_bam'].path,
                              star_log=self.output()['star_log'].path,
                              scratch_dir=os.path.join(self.scratch_dir, self.library),
+                             local_scratch=self.local_scratch,
+                             library=self.library,
                              star_genome=self.star_genome, 
                              n_cpu=self.n_cpu,
+                             sort_options=self.star_sort_options.format(sort_ram=sort_ram, bins=bins, n_cpu=self.n_cpu),
+                             rg_line=self.rg_line() if self.star_read_groups else '',
+                             shared_genome=self.shared_genome_script() if self.star_shared_genome else '',
+                             genome_load="--genomeLoad LoadAndKeep" if self.star_shared_genome else '',
                              R1=self.input()[0].path,
                              R2=self.input()[1].path,)
+                             
+    def shared_genome_script(self):
+        '''Registers the job as using the shared genome on this node, and releases it on exit'''
+        shm_dir, nodes_dir = shared_genome_dirs(self.star_genome, self.local_scratch, self.scratch_dir)
+        return '''
+                  mkdir -p {shm_dir}/jobs {nodes_dir}
+                  touch {nodes_dir}/$(hostname)
+                  ( flock 9; touch {shm_dir}/jobs/$SLURM_JOB_ID ) 9> {shm_dir}/.lock
+                  release_genome() {{
+                  rm -f {shm_dir}/jobs/$SLURM_JOB_ID
+                  {release} || true
+                  }}
+                  trap "rm -rf $local_temp; release_genome" EXIT
+                  '''.format(shm_dir=shm_dir,
+                             nodes_dir=nodes_dir,
+                             release=release_genome_script(self.star_genome, shm_dir))
+                             
+    def rg_line(self):
+        '''The read group AddReadGroups sets'''
+        return "--outSAMattrRGline ID:Star LB:{0} PL:Ilumina PU:Ilumina SM:{0}".format(self.library)
 
 @requires(Star)
 class AlignmentStats(sqla.CopyToTable):
@@ -274,7 +439,7 @@ class AlignmentStats(sqla.CopyToTable):
         return hash(str(self._rows))
 
 @requires(Star)
-class CleanSam(CheckTargetNonEmpty,SlurmExecutableTask):
+class CleanSam(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
     '''Cleans the provided SAM/BAM, soft-clipping beyond-end-of-reference alignments and setting MAPQ to 0 for unmapped reads'''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -301,8 +466,9 @@ class CleanSam(CheckTargetNonEmpty,SlurmExecutableTask):
                            picard=picard.format(mem=self.mem*self.n_cpu))
 
 @requires(CleanSam)
-class AddReadGroups(CheckTargetNonEmpty,SlurmExecutableTask):
-    '''Sets the read group to the sample name, required for GATK'''
+class AddReadGroups(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
+    '''Sets the read group to the sample name, required for GATK.
+    If the BAM from Star already has it the cleaned BAM is used as it is'''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
@@ -311,8 +477,38 @@ class AddReadGroups(CheckTargetNonEmpty,SlurmExecutableTask):
         self.partition = "tgac-short"
         
     def output(self):
+        if self.read_group_set():
+            return self.input()
         return LocalTarget(os.path.join(self.scratch_dir, self.library, 'rg_added_sorted.bam'))
     
+    def read_group_set(self):
+        '''Whether Star set the read group, from the header of the cleaned BAM or else the Star BAM.
+        Before Star has run it is whether Star will be asked to set it'''
+        if getattr(self, '_read_group_set', None) is None:
+            bams = [x.path for x in [self.input(), self.requires().input()['star_bam']] if x.exists()]
+            if not bams:
+                return self.star_read_groups
+            self._read_group_set = has_read_group(bams[0], self.library)
+        return self._read_group_set
+    
+    def on_success(self):
+        if self.read_group_set():
+            luigi.Task.on_success(self)
+        else:
+            SlurmExecutableTask.on_success(self)
+
+    def on_failure(self,e):
+        if self.read_group_set():
+            luigi.Task.on_failure(self, e)
+        else:
+            SlurmExecutableTask.on_failure(self,e)
+            
+    def run(self):
+        if self.read_group_set():
+            logger.info("Not running AddReadGroups as Star set the read group")
+        else:
+            super().run()
+    
     def work_script(self):
         return '''#!/bin/bash
                source jre-8u92
@@ -328,20 +524,36 @@ class AddReadGroups(CheckTargetNonEmpty,SlurmExecutableTask):
                            lib=self.library,
                            picard=picard.format(mem=self.mem*self.n_cpu))
 
-@requires(AddReadGroups)
-class MarkDuplicates(CheckTargetNonEmpty,SlurmExecutableTask):
-    '''Marks optical/PCR duplicates'''
+@inherits(AddReadGroups)
+class MarkDuplicates(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
+    '''Marks optical/PCR duplicates
+    :param bool fused_postprocess: Run CleanSam, AddReadGroups and MarkDuplicates on the Star BAM in this one job,
+        piping CleanSam into AddOrReplaceReadGroups and passing an uncompressed BAM to MarkDuplicates, which
+        writes the only compressed BAM and its index'''
+    fused_postprocess = luigi.BoolParameter(default=False, significant=False)
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
-        self.mem = 6000
-        self.n_cpu = 1
+        if self.fused_postprocess:
+            self.mem = 3000
+            self.n_cpu = 2
+        else:
+            self.mem = 6000
+            self.n_cpu = 1
         self.partition = "tgac-short"
         
+    def requires(self):
+        if self.fused_postprocess:
+            return self.clone(Star)
+        return self.clone(AddReadGroups)
+        
     def output(self):
         return LocalTarget(os.path.join(self.base_dir, 'libraries',self.library, 'dedupped.bam'))
     
     def work_script(self):
+        if self.fused_postprocess:
+            return self.fused_work_script()
         return '''#!/bin/bash
                source jre-8u92
                source picardtools-2.1.1
@@ -350,13 +562,48 @@ class MarkDuplicates(CheckTargetNonEmpty,SlurmExecutableTask):
                
                $picard MarkDuplicates VERBOSITY=ERROR QUIET=true I={input} O={output}.temp CREATE_INDEX=false VALIDATION_STRINGENCY=SILENT M=/dev/null
                
+               rm -f {index}
                mv {output}.temp {output}
                 '''.format(input=self.input().path, 
                            output=self.output().path,
+                           index=self.output().path[:-len('.bam')] + '.bai',
+                           picard=picard.format(mem=self.mem*self.n_cpu))
+                           
+    def fused_work_script(self):
+        '''MarkDuplicates reads its input twice so gets a level 0 BAM on scratch rather than a pipe'''
+        rg_bam = os.path.join(self.scratch_dir, self.library, 'rg_added_sorted.level0.bam')
+        if has_read_group(self.input()['star_bam'].path, self.library):
+            add_read_groups = "{picard} CleanSam VERBOSITY=ERROR QUIET=true COMPRESSION_LEVEL=0 I={input} O={rg_bam}"
+        else:
+            add_read_groups = ("{picard} CleanSam VERBOSITY=ERROR QUIET=true COMPRESSION_LEVEL=0 I={input} O=/dev/stdout |\n               "
+                               "{picard_rg} AddOrReplaceReadGroups VERBOSITY=ERROR QUIET=true COMPRESSION_LEVEL=0 I=/dev/stdin O={rg_bam} "
+                               "SO=coordinate RGID=Star RGLB={lib} RGPL=Ilumina RGPU=Ilumina RGSM={lib}")
+        add_read_groups = add_read_groups.format(input=self.input()['star_bam'].path,
+                                                 rg_bam=rg_bam,
+                                                 lib=self.library,
+                                                 picard=picard.format(mem=self.mem//2),
+                                                 picard_rg=picard.format(mem=self.mem))
+        return '''#!/bin/bash
+               source jre-8u92
+               source picardtools-2.1.1
+               set -euo pipefail
+               
+               {add_read_groups}
+               
+               {picard} MarkDuplicates VERBOSITY=ERROR QUIET=true I={rg_bam} O={temp}.bam CREATE_INDEX=true VALIDATION_STRINGENCY=SILENT M=/dev/null
+               rm {rg_bam}
+               
+               mv {temp}.bai {index}
+               mv {temp}.bam {output}
+                '''.format(output=self.output().path,
+                           temp=self.output().path[:-len('.bam')] + '.temp',
+                           index=self.output().path[:-len('.bam')] + '.bai',
+                           rg_bam=rg_bam,
+                           add_read_groups=add_read_groups,
                            picard=picard.format(mem=self.mem*self.n_cpu))
 
 @requires(MarkDuplicates)
-class BaseQualityScoreRecalibration(SlurmExecutableTask):
+class BaseQualityScoreRecalibration(PrefetchedComplete, ModelledResources, SlurmExecutableTask):
     '''Runs BQSR. Because this requires a set of high quality SNPs to use
     as a ground truth we bootstrap this by first running the pipeline without
     BQSR then running again using the best SNPs of the first run.
@@ -409,15 +656,17 @@ class BaseQualityScoreRecalibration(SlurmExecutableTask):
                   $gatk -T BaseRecalibrator  -R {reference}  -I {input}  -knownSites {snp_db}  -o {recal}
                   $gatk -T PrintReads -R {reference} -I {input} -BQSR {recal} -o {output}.temp
                   
+                  rm -f {index}
                   mv {output}.temp {output}
                 '''.format(gatk=gatk.format(mem=self.mem*self.n_cpu),
                            input=self.input().path,
                            output=self.output().path,
+                           index=self.output().path[:-len('.bam')] + '.bai',
                            reference=self.reference,
                            recal=recal)
 
 @requires(BaseQualityScoreRecalibration)
-class SplitNCigarReads(CheckTargetNonEmpty,SlurmExecutableTask):
+class SplitNCigarReads(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
     '''Required by GATK, breaks up reads spanning introns'''
     reference = luigi.Parameter()
     
@@ -440,20 +689,38 @@ class SplitNCigarReads(CheckTargetNonEmpty,SlurmExecutableTask):
                picard='{picard}'
                set -euo pipefail
                
-               $picard BuildBamIndex VERBOSITY=ERROR QUIET=true I={input}
+               # MarkDuplicates with fused_postprocess has already indexed it
+               [ -s {index} ] || $picard BuildBamIndex VERBOSITY=ERROR QUIET=true I={input}
                $gatk -T SplitNCigarReads --logging_level ERROR -R {reference} -I {input} -o {output}.temp -rf ReassignOneMappingQuality -RMQF 255 -RMQT 60 -U ALLOW_N_CIGAR_READS
                
                mv {output}.temp.bai {output}.bai
                mv {output}.temp {output}
                 '''.format(input=self.input().path, 
                            output=self.output().path,
+                           index=self.input().path[:-len('.bam')] + '.bai',
                            picard=picard.format(mem=self.mem*self.n_cpu),
                            gatk=gatk.format(mem=self.mem*self.n_cpu),
                            reference=self.reference) 
 
-@requires(SplitNCigarReads)
-class HaplotypeCaller(CheckTargetNonEmpty, SlurmExecutableTask):
-    '''Per sample SNP calling'''
+class ReferenceIntervals(luigi.Task):
+    '''BED of every contig of the reference, from its .fai, for scattering over the genome'''
+    reference = luigi.Parameter()
+    base_dir = luigi.Parameter(significant=False)
+    
+    def output(self):
+        return LocalTarget(os.path.join(self.base_dir, 'libraries', os.path.basename(self.reference) + '.bed'))
+        
+    def run(self):
+        with open(self.reference + '.fai') as fai, self.output().open('w') as fout:
+            for l in fai:
+                contig, length = l.split('\t')[:2]
+                fout.write("{0}\t0\t{1}\n".format(contig, length))
+
+@inherits(SplitNCigarReads)
+class HaplotypeCaller(PrefetchedComplete, CheckTargetNonEmpty, ModelledResources, SlurmExecutableTask):
+    '''Per sample SNP calling. Writes a bgzipped and tabix indexed GVCF, an uncompressed .g.vcf
+    from before is compressed in place of calling again.
+    When scattered (hc_scatter > 1) each shard calls over its contigs of ReferenceIntervals'''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Set the SLURM request params for this task
@@ -462,9 +729,29 @@ class HaplotypeCaller(CheckTargetNonEmpty, SlurmExecutableTask):
         self.partition = "tgac-medium"
         
     def output(self):
-        return LocalTarget(os.path.join(self.base_dir, 'libraries', self.library, self.library + ".g.vcf"))
+        return LocalTarget(os.path.join(self.base_dir, 'libraries', self.library, self.library + ".g.vcf.gz"))
+        
+    def legacy_output(self):
+        '''The library's uncompressed .g.vcf, the same for every shard when scattered'''
+        return os.path.join(self.base_dir, 'libraries', self.library, self.library + ".g.vcf")
+        
+    def migrating(self):
+        '''Whether there is a legacy .g.vcf that the bgzipped GVCF has not yet replaced'''
+        return os.path.exists(self.legacy_output()) and not os.path.exists(self.legacy_output() + '.gz')
+        
+    def requires(self):
+        # Migrating an old output doesn't need the BAM
+        if hc_scatter > 1:
+            if self.migrating():
+                return {'intervals':self.clone(ReferenceIntervals)}
+            return {'intervals':self.clone(ReferenceIntervals), 'bam':self.clone(SplitNCigarReads)}
+        if self.migrating():
+            return []
+        return self.clone(SplitNCigarReads)
         
     def work_script(self):
+        if self.migrating():
+            return self.migrate_script()
         return '''#!/bin/bash
                set -euo pipefail
                 source jre-8u92
@@ -472,16 +759,59 @@ class HaplotypeCaller(CheckTargetNonEmpty, SlurmExecutableTask):
                 gatk='{gatk}'
                 set -euo pipefail
                 
-                $gatk -T HaplotypeCaller  -R {reference} -I {input} -dontUseSoftClippedBases --variant_index_type LINEAR --variant_index_parameter 128000 --emitRefConfidence GVCF -o {output}.temp
+                $gatk -T HaplotypeCaller  -R {reference} -I {input} {intervals} -dontUseSoftClippedBases --emitRefConfidence GVCF -o {output}.temp.g.vcf.gz
                 
-                mv {output}.temp {output}
-        '''.format(input=self.input().path, 
+                mv {output}.temp.g.vcf.gz.tbi {output}.tbi
+                mv {output}.temp.g.vcf.gz {output}
+        '''.format(input=self.clone(SplitNCigarReads).output().path, 
                    output=self.output().path,
+                   intervals="-L " + self.input().path if hc_scatter > 1 else "",
                    gatk=gatk.format(mem=self.mem*self.n_cpu),
                    reference=self.reference) 
+        
+    def migrate_script(self):
+        if hc_scatter > 1:
+            # Each shard takes its contigs from the old GVCF, GatherGVCF removes it once they are gathered
+            return '''#!/bin/bash
+                source bcftools-1.3.1;
+                set -euo pipefail
+                
+                bcftools view -T {intervals} -O z -o {output}.temp {legacy}
+                tabix -p vcf {output}.temp
+                
+                mv {output}.temp.tbi {output}.tbi
+                mv {output}.temp {output}
+        '''.format(legacy=self.legacy_output(),
+                   intervals=self.input().path,
+                   output=self.output().path)
+        return '''#!/bin/bash
+                source bcftools-1.3.1;
+                set -euo pipefail
+                
+                bgzip -c {legacy} > {output}.temp
+                tabix -p vcf {output}.temp
+                
+                mv {output}.temp.tbi {output}.tbi
+                mv {output}.temp {output}
+                rm -f {legacy} {legacy}.idx
+        '''.format(legacy=self.legacy_output(),
+                   output=self.output().path)
+
+class GatherGVCF(GatherVCF):
+    '''Gathers the HaplotypeCaller shards, then removes the library's legacy .g.vcf they were migrated from'''
+    def work_script(self):
+        return super().work_script() + '''
+                if [ -s {output} ] && [ -s {output}.tbi ]; then
+                    rm -f {legacy} {legacy}.idx
+                fi
+                '''.format(output=self.output().path,
+                           legacy=self.output().path[:-len('.gz')])
+
+if hc_scatter > 1:
+    HaplotypeCaller = ScatterGather(ScatterBED, GatherGVCF, hc_scatter)(HaplotypeCaller)
 
 @requires(HaplotypeCaller)
-class PlotAlleleFreq(SlurmExecutableTask):
+class PlotAlleleFreq(PrefetchedComplete, ModelledResources, SlurmExecutableTask):
     '''Make plots of the ranked allele frequencies to identify mixed isolates'''
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -531,19 +861,62 @@ class PerLibPipeline(luigi.WrapperTask):
 class CleanUpLib(luigi.Task):
     priority = 100
     def run(self):
+        utils.discard_completed(os.path.join(self.scratch_dir, self.library))
         shutil.rmtree(os.path.join(self.scratch_dir, self.library), ignore_errors=True)
     def complete(self):
         return self.clone_parent().complete() and not os.path.exists(os.path.join(self.scratch_dir, self.library))
 
+@inherits(CleanUpLib)
+class UnloadStarGenome(luigi.Task):
+    '''Removes the shared memory genome from every node a Star job with ``star_shared_genome`` ran on,
+    once all the libraries of :param list lib_list: are done. Nodes where a job is still using it are
+    kept for the next run to try again. Depends on CleanUpLib rather than Star, as the Star BAM on
+    scratch is gone once a library is cleaned up'''
+    lib_list = luigi.ListParameter()
+    library = None
+    
+    def requires(self):
+        return [self.clone(CleanUpLib, library=lib.rstrip()) for lib in self.lib_list]
+        
+    def nodes(self):
+        shm_dir, nodes_dir = shared_genome_dirs(self.star_genome, self.local_scratch, self.scratch_dir)
+        return os.listdir(nodes_dir) if os.path.isdir(nodes_dir) else []
+        
+    def complete(self):
+        return all([x.complete() for x in self.requires()]) and not self.nodes()
+        
+    def run(self):
+        shm_dir, nodes_dir = shared_genome_dirs(self.star_genome, self.local_scratch, self.scratch_dir)
+        script = "source star-2.5.0a\n" + release_genome_script(self.star_genome, shm_dir)
+        for node in self.nodes():
+            rc = subprocess.call(['srun', '-N1', '-n1', '-p', 'tgac-short', '-w', node, 'bash', '-c', script])
+            if rc == 0:
+                os.remove(os.path.join(nodes_dir, node))
+            else:
+                logger.warning("Shared STAR genome not removed from {0}, exit status {1}".format(node, rc))
+
 @inherits(CleanUpLib)        
 class LibraryBatchWrapper(luigi.WrapperTask):
     '''Wrapper task to execute the per library part of the pipline on all
-        libraries in :param list lib_list:'''
+        libraries in :param list lib_list:
+        Before luigi walks the DAG the completeness of every task is checked on
+        :param int complete_threads: threads, 0 to check serially'''
     lib_list = luigi.ListParameter()        
+    complete_threads = luigi.IntParameter(default=32, significant=False)
     library=None
+    _prefetched = False
+    
     def requires(self):
         for lib in self.lib_list:
             yield self.clone_parent(library=lib.rstrip())
+        if self.star_shared_genome:
+            yield self.clone(UnloadStarGenome)
+            
+    def complete(self):
+        if self.complete_threads > 0 and not self._prefetched:
+            utils.prefetch_complete(self, self.complete_threads)
+            self._prefetched = True
+        return super().complete()
 # This is a bit of a hack, it allows us to pass parameters to LibraryBatchWrapper and have them propagate
 # down to all calls to PerLibPipeline.
 LibraryBatchWrapper.library=None
@@ -9,6 +9,8 @@ from luigi.util import requires, inherits
 from luigi import LocalTarget
 from luigi.file import TemporaryFile
 
+from src.utils import ModelledResources
+
 from SNP_calling import GetRefSNPSs, picard
 
 class GetVCF(luigi.ExternalTask):
@@ -21,7 +23,7 @@ class GetVCF(luigi.ExternalTask):
         return LocalTarget(self.ref_snp_vcf)
         
 @requires(GetVCF)
-class ConvertToBCF(SlurmExecutableTask):
+class ConvertToBCF(ModelledResources, SlurmExecutableTask):
     '''Use bcftools view to convert the vcf to bcf, its worth doing this conversion 
      as the bcf formatted file is much faster for separating the samples than the vcf'''
     
@@ -44,7 +46,7 @@ class ConvertToBCF(SlurmExecutableTask):
 
 
 @requires(ConvertToBCF)
-class GetSingleSample(SlurmExecutableTask):
+class GetSingleSample(ModelledResources, SlurmExecutableTask):
     '''Pull a single sample out of the joint BCF file and use picard to compute a BED file where there is missing data'''
     library = luigi.Parameter()
     
@@ -80,7 +82,7 @@ class GetSingleSample(SlurmExecutableTask):
 
 
 @requires(GetSingleSample)        
-class BCFtoolsConsensus(SlurmExecutableTask):
+class BCFtoolsConsensus(ModelledResources, SlurmExecutableTask):
     '''Apply the variants in the vcf file and mask with the missing data BED file.
        :param str consensus_type: can be H1 or H2 for applying one of the (pseudo) haplotypes or iupac-codes for ambiguous coding'''
 
@@ -115,7 +117,7 @@ class BCFtoolsConsensus(SlurmExecutableTask):
                            consensus_type=ct_flag)
 
 @requires(BCFtoolsConsensus)
-class GFFread(SlurmExecutableTask):
+class GFFread(ModelledResources, SlurmExecutableTask):
     '''Pull out the spliced exons from the genomes'''
     gff = luigi.Parameter()
     
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import zlib
+import struct
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from scatter_vcf import BGZF_BLOCK, BGZF_EOF, CONTIG_RE, bgzf_compress
+
+BUFFER_SIZE = 2**24
+NOT_CONCATENABLE = 3 # Exit status when the shards need a real merge
+
+class NotConcatenable(Exception):
+    pass
+
+def block_offsets(path):
+    '''Offsets and compressed sizes of the BGZF blocks of ``path`` from their headers, without decompressing'''
+    blocks = []
+    with open(path, 'rb') as fh:
+        offset = 0
+        while True:
+            header = fh.read(18)
+            if not header:
+                break
+            if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+                raise NotConcatenable("{0} is not BGZF compressed at offset {1}".format(path, offset))
+            size = struct.unpack('<H', header[16:18])[0] + 1
+            blocks.append((offset, size))
+            offset += size
+            fh.seek(offset)
+    return blocks
+
+def inflate(fh, offset, size):
+    fh.seek(offset)
+    return zlib.decompress(fh.read(size)[18:-8], -15)
+
+def sort_key(line, contigs):
+    fields = line.split(b'\t', 2)
+    if fields[0] not in contigs:
+        raise NotConcatenable("Contig {0} not in the header".format(fields[0].decode()))
+    return contigs[fields[0]], int(fields[1])
+
+class VCFShard():
+    '''Locates the header, first and last record of a bgzipped VCF by decompressing only the blocks
+    at either end. Records start in ``first_block`` at ``first_within`` and run to the end of
+    ``blocks``, excluding the EOF block'''
+    def __init__(self, path):
+        self.path = path
+        self.blocks = block_offsets(path)
+        if self.blocks and self.blocks[-1][1] == len(BGZF_EOF):
+            self.blocks.pop()
+
+        self.first, self.last = None, None
+        with open(path, 'rb') as fh:
+            data, end = b'', None
+            for i, (offset, size) in enumerate(self.blocks):
+                start = len(data)
+                data += inflate(fh, offset, size)
+                if end is None:
+                    end = self.header_end(data)
+                    if end is not None and end < len(data):
+                        self.header = data[:end]
+                        self.first_block, self.first_within = i, end - start
+                    else:
+                        end = None
+                # Enough to read the position of the first record
+                if end is not None and data.find(b'\n', end) >= 0:
+                    self.first = data[end:data.find(b'\n', end)]
+                    break
+            else:
+                if end is None:
+                    # Header only
+                    self.header = data
+                    return
+                self.first = data[end:]
+
+            # Read back from the end until there is a whole final line
+            tail = b''
+            for offset, size in reversed(self.blocks):
+                tail = inflate(fh, offset, size) + tail
+                if tail.rstrip(b'\n').rfind(b'\n') >= 0 or offset <= self.blocks[self.first_block][0]:
+                    break
+            self.last = tail.rstrip(b'\n').rsplit(b'\n', 1)[-1]
+
+    @staticmethod
+    def header_end(data):
+        '''Offset of the first record in ``data`` if the whole header has been read'''
+        pos = 0
+        while True:
+            if pos >= len(data):
+                return None
+            if data[pos:pos + 1] != b'#':
+                return pos
+            nl = data.find(b'\n', pos)
+            if nl < 0:
+                return None
+            pos = nl + 1
+
+    def samples(self):
+        return self.header.rstrip(b'\n').rsplit(b'\n', 1)[-1]
+
+def copy_range(src, start, length, dest_fd, offset):
+    '''Copy ``length`` bytes of ``src`` from ``start`` into the open file ``dest_fd`` at ``offset``'''
+    with open(src, 'rb', buffering=0) as fh:
+        fh.seek(start)
+        while length > 0:
+            buf = fh.read(min(BUFFER_SIZE, length))
+            if not buf:
+                raise Exception("{0} truncated".format(src))
+            written = 0
+            while written < len(buf):
+                written += os.pwrite(dest_fd, buf[written:], offset + written)
+            offset += len(buf)
+            length -= len(buf)
+
+def compress(data):
+    return b''.join([bgzf_compress(data[i:i + BGZF_BLOCK]) for i in range(0, len(data), BGZF_BLOCK)])
+
+def concat_vcf(output, inputs, threads=1):
+    '''Concatenate the coordinate ordered bgzipped VCF shards ``inputs`` into ``output``, copying the
+    compressed blocks as they are. Only the header and the block each shard's records start in are
+    recompressed. Raises NotConcatenable if the shards overlap or their samples differ'''
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        shards = list(pool.map(VCFShard, inputs))
+    if not shards:
+        raise NotConcatenable("No shards")
+
+    header = shards[0].header
+    contigs = dict([(m.group(1), i) for i, m in enumerate(filter(None, [CONTIG_RE.match(l) for l in header.split(b'\n')]))])
+    last = None
+    for shard in shards:
+        if shard.samples() != shards[0].samples():
+            raise NotConcatenable("{0} has different samples to {1}".format(shard.path, shards[0].path))
+        if shard.first is None:
+            continue
+        if last is not None and sort_key(shard.first, contigs) < sort_key(last.last, contigs):
+            raise NotConcatenable("{0} starts before the end of {1}".format(shard.path, last.path))
+        last = shard
+
+    # Lay out the output: header, then per shard the rest of its first block and its remaining blocks raw
+    pieces, offset = [], 0
+    def add(piece, size):
+        nonlocal offset
+        pieces.append((piece, offset))
+        offset += size
+    head = compress(header)
+    add(head, len(head))
+    for shard in shards:
+        if shard.first is None:
+            continue
+        with open(shard.path, 'rb') as fh:
+            first = compress(inflate(fh, *shard.blocks[shard.first_block])[shard.first_within:])
+        add(first, len(first))
+        if shard.first_block + 1 < len(shard.blocks):
+            start = shard.blocks[shard.first_block + 1][0]
+            end = shard.blocks[-1][0] + shard.blocks[-1][1]
+            add((shard.path, start, end - start), end - start)
+    add(BGZF_EOF, len(BGZF_EOF))
+
+    fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, offset)
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            jobs = []
+            for piece, at in pieces:
+                if isinstance(piece, bytes):
+                    os.pwrite(fd, piece, at)
+                else:
+                    jobs.append(pool.submit(copy_range, piece[0], piece[1], piece[2], fd, at))
+            for j in jobs:
+                j.result()
+    finally:
+        os.close(fd)
+    print("Concatenated {0} shards into {1}, {2} bytes".format(len(shards), output, offset))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concatenate coordinate ordered bgzipped VCF shards without recompressing. "
+                                                 "Exits with status {0} if they need merging instead".format(NOT_CONCATENABLE))
+    parser.add_argument('output')
+    parser.add_argument('inputs', nargs='+')
+    parser.add_argument('--threads', required=False, default=1, type=int)
+    args = parser.parse_args()
+
+    try:
+        concat_vcf(args.output, args.inputs, args.threads)
+    except NotConcatenable as e:
+        print("Can't concatenate: " + str(e))
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        sys.exit(NOT_CONCATENABLE)
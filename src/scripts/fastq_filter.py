@@ -1,41 +1,344 @@
 #!/usr/bin/env python
 
+import os
+import re
+import math
 import gzip
 import argparse
 import io
+import time
+import resource
+import queue
+import multiprocessing
+from collections import deque
+
+import numpy as np
+
+NEWLINE, AT, N = ord('\n'), ord('@'), ord('N')
 
 
 class no_Ns():
     '''Filter any read that contains an N'''
-    def __init__(self):
-        self.failures = 0
-        
+    name = "No N's"
+    uses_quality = False
+    
     def __call__(self, r1, r2):
-        predicate = not (('N' in r1) or ('N' in r2))
-        if not predicate:
-            self.failures += 1
-        return predicate
+        return not (('N' in r1) or ('N' in r2))
 
-    def __str__(self):
-        return "No N's: {0}".format(self.failures)
+    def mask(self, b1, b2):
+        return (b1.count_in_seq(N) == 0) & (b2.count_in_seq(N) == 0)
         
 class exact_length():
     '''Filter any read that does not have length ``L``
     :param L: Read filter length
     '''
+    name = "Exact length"
+    uses_quality = False
+    
     def __init__(self, L=101):
         self.L = L + 1 #Add 1 to count the newline
-        self.failures = 0
         
     def __call__(self, r1, r2):
-        predicate = (len(r1) == self.L) and (len(r2) == self.L)         
-        if not predicate:
-            self.failures += 1
+        return (len(r1) == self.L) and (len(r2) == self.L)
+        
+    def mask(self, b1, b2):
+        return (b1.seq_len == self.L - 1) & (b2.seq_len == self.L - 1)
+        
+class mean_quality():
+    '''Filter any read whose mean base call quality is below ``Q``
+    :param Q: Minimum mean quality
+    :param offset: Quality encoding offset, 33 for Sanger/Illumina 1.8+
+    '''
+    name = "Mean quality"
+    uses_quality = True
+    
+    def __init__(self, Q=20, offset=33):
+        self.Q = Q
+        self.offset = offset
+        
+    def _passes(self, q):
+        q = q.rstrip().encode()
+        return len(q) > 0 and sum(q) >= (self.Q + self.offset)*len(q)
+        
+    def __call__(self, r1, r2, q1, q2):
+        return self._passes(q1) and self._passes(q2)
+        
+    def mask(self, b1, b2):
+        masks = []
+        for b in (b1, b2):
+            L = b.qual_len
+            masks.append((L > 0) & (b.qual_sum() >= (self.Q + self.offset)*L))
+        return masks[0] & masks[1]
+
+class adapter_match():
+    '''Filter any read containing one of ``adapters`` or a poly-A run of length ``polyA``
+    :param adapters: List of adapter sequences, by default the common prefix of the TruSeq adapters
+    :param polyA: Length of poly-A run to filter, 0 to disable
+    '''
+    name = "Adapter/poly-A"
+    uses_quality = False
+    
+    def __init__(self, adapters=('AGATCGGAAGAGC',), polyA=20):
+        self.patterns = list(adapters) + (['A'*polyA] if polyA else [])
+        
+    def __call__(self, r1, r2):
+        return not any((p in r1) or (p in r2) for p in self.patterns)
+        
+    def mask(self, b1, b2):
+        predicate = np.ones(b1.n, dtype=bool)
+        for p in self.patterns:
+            predicate &= ~b1.find_in_seq(p) & ~b2.find_in_seq(p)
+        return predicate
+
+class low_complexity():
+    '''Filter any read where the Shannon entropy of the base composition is below ``min_entropy`` bits.
+    Homopolymers score 0, dinucleotide repeats 1 and random sequence close to 2
+    :param min_entropy: Minimum entropy in bits
+    '''
+    name = "Low complexity"
+    uses_quality = False
+    
+    def __init__(self, min_entropy=1.5):
+        self.min_entropy = min_entropy
+        
+    def _entropy(self, r):
+        L = len(r.rstrip())
+        if L == 0:
+            return 0
+        p = [r.count(b)/L for b in 'ACGT']
+        return -sum(x*math.log2(x) for x in p if x > 0)
+        
+    def __call__(self, r1, r2):
+        return (self._entropy(r1) >= self.min_entropy) and (self._entropy(r2) >= self.min_entropy)
+        
+    def _entropy_mask(self, b):
+        L = np.maximum(b.seq_len, 1)
+        entropy = np.zeros(b.n)
+        for base in b'ACGT':
+            p = b.count_in_seq(base)/L
+            entropy -= p*np.log2(np.where(p > 0, p, 1))
+        return (b.seq_len > 0) & (entropy >= self.min_entropy)
+        
+    def mask(self, b1, b2):
+        return self._entropy_mask(b1) & self._entropy_mask(b2)
+
+class FastqBlock():
+    '''A batch of whole fastq records held in a single byte array, so the
+    filters can be evaluated as masks over every record at once
+    :param bytes data: Decompressed fastq containing only complete records
+    '''
+    def __init__(self, data):
+        self.data = data
+        self.arr = np.frombuffer(data, dtype=np.uint8)
+        
+        newlines = np.flatnonzero(self.arr == NEWLINE)
+        if len(data) > 0 and data[-1] != NEWLINE:
+            # Final line of the file has no trailing newline
+            newlines = np.append(newlines, len(data))
+        if len(newlines) % 4 != 0:
+            raise Exception("Block does not contain a whole number of records!!")
+            
+        line_starts = np.concatenate(([0], newlines[:-1] + 1))
+        self.rec_start = line_starts[0::4]
+        self.rec_end = np.minimum(newlines[3::4] + 1, len(data))
+        self.seq_start = line_starts[1::4]
+        self.seq_end = newlines[1::4]
+        self.qual_start = line_starts[3::4]
+        self.qual_end = newlines[3::4]
+        self.n = len(self.rec_start)
+        
+    @property
+    def seq_len(self):
+        return self.seq_end - self.seq_start
+        
+    @property
+    def qual_len(self):
+        return self.qual_end - self.qual_start
+        
+    def headers_ok(self):
+        return bool(np.all(self.arr[self.rec_start] == AT))
+        
+    def _line_sums(self, values, start, end):
+        '''Sum ``values`` over the range [start, end) of each record'''
+        if self.n == 0:
+            return np.zeros(0, dtype=np.int64)
+        if end[-1] >= len(values):
+            values = np.append(values, 0)
+        idx = np.empty(2*self.n, dtype=np.int64)
+        idx[0::2], idx[1::2] = start, end
+        sums = np.add.reduceat(values, idx, dtype=np.int64)[0::2]
+        sums[start == end] = 0
+        return sums
+        
+    def count_in_seq(self, byte):
+        '''Count the occurrences of ``byte`` in the sequence line of each record'''
+        hits = self.arr == byte
+        pos = np.flatnonzero(hits)
+        if len(pos) > self.n:
+            return self._line_sums(hits, self.seq_start, self.seq_end)
+        # Rare bytes, cheaper to place each hit in its record
+        idx = np.searchsorted(self.seq_start, pos, side='right') - 1
+        inside = (idx >= 0) & (pos < self.seq_end[np.maximum(idx, 0)])
+        return np.bincount(idx[inside], minlength=self.n)
+        
+    def qual_sum(self):
+        '''Sum of the raw quality bytes of each record'''
+        return self._line_sums(self.arr, self.qual_start, self.qual_end)
+        
+    def find_in_seq(self, pattern):
+        '''True for each record whose sequence line contains ``pattern``'''
+        pos = np.array([m.start() for m in re.finditer(re.escape(pattern.encode()), self.data)], dtype=np.int64)
+        found = np.zeros(self.n, dtype=bool)
+        if len(pos) == 0:
+            return found
+        idx = np.searchsorted(self.seq_start, pos, side='right') - 1
+        inside = (idx >= 0) & (pos + len(pattern) <= self.seq_end[np.maximum(idx, 0)])
+        found[idx[inside]] = True
+        return found
+        
+    def select(self, keep):
+        '''Return the raw bytes of the records where ``keep`` is True.
+        Consecutive kept records are copied as a single slice'''
+        if self.n == 0 or not keep.any():
+            return b''
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], keep, [False])).astype(np.int8)))
+        starts, ends = self.rec_start[edges[0::2]], self.rec_end[edges[1::2] - 1]
+        return b''.join([self.data[s:e] for s,e in zip(starts, ends)])
+        
+class FilterChain():
+    '''Applies a list of filters to each read pair, stopping at the first filter that rejects it.
+    Every ``reorder_every`` pairs the filters are reordered so that those which reject the most
+    reads for the least time run first. Each filter has its time sampled every ``time_every`` pairs.
+    :param filters: List of filters, called as ``f(r1, r2)`` or ``f(r1, r2, q1, q2)`` if ``f.uses_quality``
+    '''
+    def __init__(self, filters, reorder_every=2**16, time_every=2**6):
+        self.filters = list(filters)
+        self.reorder_every = reorder_every
+        self.time_every = time_every
+        
+        self.order = list(range(len(self.filters)))
+        self.uses_quality = [getattr(f, 'uses_quality', False) for f in self.filters]
+        self.evaluated = [0]*len(self.filters)
+        self.rejected = [0]*len(self.filters)
+        self.time = [0.]*len(self.filters)
+        self.timed = [0]*len(self.filters)
+        self.pairs = 0
+        
+    def _call(self, i, r1, r2, q1, q2):
+        if self.uses_quality[i]:
+            return self.filters[i](r1, r2, q1, q2)
+        return self.filters[i](r1, r2)
+        
+    def __call__(self, r1, r2, q1=None, q2=None):
+        self.pairs += 1
+        timed = self.pairs % self.time_every == 0
+        predicate = True
+        for i in self.order:
+            self.evaluated[i] += 1
+            if timed:
+                start = time.perf_counter()
+                predicate = self._call(i, r1, r2, q1, q2)
+                self.time[i] += time.perf_counter() - start
+                self.timed[i] += 1
+            else:
+                predicate = self._call(i, r1, r2, q1, q2)
+            if not predicate:
+                self.rejected[i] += 1
+                break
+                
+        if self.pairs % self.reorder_every == 0:
+            self.reorder()
         return predicate
         
+    def mask(self, b1, b2):
+        '''Vectorised version of __call__ for :class:`FastqBlock`, filters are skipped once the whole block is rejected'''
+        keep = np.ones(b1.n, dtype=bool)
+        for i in self.order:
+            if not keep.any():
+                break
+            start = time.perf_counter()
+            predicate = self.filters[i].mask(b1, b2)
+            self.time[i] += time.perf_counter() - start
+            self.timed[i] += b1.n
+            
+            self.evaluated[i] += int(np.count_nonzero(keep))
+            self.rejected[i] += int(np.count_nonzero(keep & ~predicate))
+            keep &= predicate
+            
+        self.pairs += b1.n
+        self.reorder()
+        return keep
+        
+    def reorder(self):
+        '''Order filters by cost per rejection, cheapest first'''
+        def rank(i):
+            if self.rejected[i] == 0:
+                return float('inf')
+            cost = self.time[i]/self.timed[i] if self.timed[i] else 0
+            return cost*self.evaluated[i]/self.rejected[i]
+        self.order.sort(key=rank)
+        
     def __str__(self):
-        return "Exact length: {0}".format(self.failures)
+        return "\t".join(["{0}: {1} ({2:.2f}us/pair)".format(f.name, self.rejected[i], 1e6*self.time[i]/max(self.timed[i], 1))
+                          for i,f in enumerate(self.filters)])
         
+def iter_blocks(path, records):
+    '''Decompress ``path`` and yield the raw bytes of blocks of ``records`` fastq records'''
+    with open(path, 'rb', buffering=2**27) as gz_fh:
+        fh = gzip.GzipFile(mode='r', fileobj=gz_fh)
+        buf = b''
+        while True:
+            chunk = fh.read(2**24)
+            buf += chunk
+            
+            newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == NEWLINE)
+            while len(newlines) >= 4*records:
+                cut = newlines[4*records - 1] + 1
+                yield buf[:cut]
+                buf = buf[cut:]
+                newlines = newlines[4*records:] - cut
+                
+            if not chunk:
+                break
+                
+        if buf:
+            yield buf
+
+def read_blocks(path, out_queue, records):
+    '''Put the blocks from :func:`iter_blocks` on ``out_queue``.
+    Run in its own process, sends None when the file is exhausted'''
+    for data in iter_blocks(path, records):
+        out_queue.put(data)
+    out_queue.put(None)
+    
+class AtomicOutput():
+    '''Write only file object that streams to ``path``.tmp through a bounded buffer
+    and renames it over ``path`` when the context exits cleanly, so a failed run never
+    leaves a partial output at ``path``. On an exception the temporary file is removed
+    :param str path: Final output path
+    :param int buffer_size: Size of the write buffer in bytes
+    '''
+    def __init__(self, path, buffer_size=2**24):
+        self.path = path
+        self.temp = path + '.tmp'
+        self.fh = open(self.temp, 'wb', buffering=buffer_size)
+        
+    def write(self, data):
+        return self.fh.write(data)
+        
+    def flush(self):
+        self.fh.flush()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.fh.close()
+        if exc_type is None:
+            os.replace(self.temp, self.path)
+        else:
+            os.remove(self.temp)
+            
 class FastqFilter():
     def __init__(self, in_r1, in_r2, out_r1, out_r2, filters):
         
@@ -43,20 +346,20 @@ class FastqFilter():
         self.in_r2 = in_r2
         self.out_r1 = out_r1
         self.out_r2 = out_r2
-        self.filters = filters
+        self.filters = filters if isinstance(filters, FilterChain) else FilterChain(filters)
         
         self.apply()
 
     def apply(self):
+        start = time.time()
         
         ## Use mid sized caches 134mb to reduce network load
-        with open(self.in_r1, 'rb', buffering=2**27) as r1_in_gz, open(self.in_r2, 'rb', buffering=2**27) as r2_in_gz:
+        with open(self.in_r1, 'rb', buffering=2**27) as r1_in_gz, open(self.in_r2, 'rb', buffering=2**27) as r2_in_gz, \
+             AtomicOutput(self.out_r1) as r1_out_fh, AtomicOutput(self.out_r2) as r2_out_fh:
             r1_in_fh = io.TextIOWrapper(gzip.GzipFile(mode='r', fileobj=r1_in_gz))
             r2_in_fh = io.TextIOWrapper(gzip.GzipFile(mode='r', fileobj=r2_in_gz))
             
-            ## Fully buffer the output files, so script is (more) atomic
-            r1_buf, r2_buf = io.BytesIO(), io.BytesIO()
-            r1_out_gz, r2_out_gz = gzip.GzipFile(mode='w', fileobj=r1_buf), gzip.GzipFile(mode='w', fileobj=r2_buf)
+            r1_out_gz, r2_out_gz = gzip.GzipFile(mode='w', fileobj=r1_out_fh), gzip.GzipFile(mode='w', fileobj=r2_out_fh)
             r1_out_text, r2_out_text = io.TextIOWrapper(r1_out_gz),io.TextIOWrapper(r2_out_gz)
             
             in_count, out_count = 0,0
@@ -71,7 +374,7 @@ class FastqFilter():
                 r1_qual, r2_qual = next(zipped)
                 
                 in_count += 1
-                if all([f(r1_seq, r2_seq) for f in self.filters]):
+                if self.filters(r1_seq, r2_seq, r1_qual, r2_qual):
                     out_count += 1
                     r1_out_text.writelines([r1_header, r1_seq, r1_desc, r1_qual])
                     r2_out_text.writelines([r2_header, r2_seq, r2_desc, r2_qual])
@@ -79,15 +382,94 @@ class FastqFilter():
                 #if in_count > 100000:
                 #    break
             
-            with open(self.out_r1, 'wb') as r1_out_fh, open(self.out_r2, 'wb',) as r2_out_fh:
-                r1_out_text.flush()
-                r2_out_text.flush()
-                r1_out_gz.close()
-                r2_out_gz.close()
-                r1_out_fh.write(r1_buf.getvalue())
-                r2_out_fh.write(r2_buf.getvalue())
+            r1_out_text.flush()
+            r2_out_text.flush()
+            r1_out_gz.close()
+            r2_out_gz.close()
+                
+        self.report(in_count, start)
+        
+    def report(self, in_count, start):
+        '''Print the filter failures along with the peak memory use and the throughput of the compressed input'''
+        elapsed = max(time.time() - start, 1e-6)
+        in_mb = (os.path.getsize(self.in_r1) + os.path.getsize(self.in_r2))/1024**2
+        ## ru_maxrss is in KB on linux, RUSAGE_CHILDREN covers the reader/compressor processes
+        peak_mb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/1024
+        print("In : {0} Failed: ".format(in_count) + str(self.filters) +
+              "\tPeak RSS: {0:.0f} MB\tThroughput: {1:.1f} MB/s".format(peak_mb, in_mb/elapsed))
+
+class BlockFastqFilter(FastqFilter):
+    '''Multiprocess version of :class:`FastqFilter`. Each mate is decompressed in its own process
+    and parsed in blocks of ``block_records`` records, the filters are applied as vectorised masks
+    over the whole block and the output is compressed by a pool of ``threads`` workers.
+    The decompressed output is identical to :class:`FastqFilter`, but each block is written as a separate gzip member
+    '''
+    def __init__(self, in_r1, in_r2, out_r1, out_r2, filters, threads=1, block_records=2**16):
+        self.threads = threads
+        self.block_records = block_records
+        super().__init__(in_r1, in_r2, out_r1, out_r2, filters)
+        
+    @staticmethod
+    def _get(in_queue, reader):
+        '''Get the next block from ``in_queue`` failing if the ``reader`` process has died'''
+        while True:
+            try:
+                return in_queue.get(timeout=10)
+            except queue.Empty:
+                if not reader.is_alive():
+                    raise Exception("Reader process exited with code {0}".format(reader.exitcode))
+                    
+    def apply(self):
+        start = time.time()
+        
+        ## Bound the number of blocks in flight to limit memory use
+        r1_queue = multiprocessing.Queue(maxsize=self.threads + 1)
+        r2_queue = multiprocessing.Queue(maxsize=self.threads + 1)
+        r1_reader = multiprocessing.Process(target=read_blocks, args=(self.in_r1, r1_queue, self.block_records), daemon=True)
+        r2_reader = multiprocessing.Process(target=read_blocks, args=(self.in_r2, r2_queue, self.block_records), daemon=True)
+        r1_reader.start()
+        r2_reader.start()
+        
+        in_count, out_count = 0,0
+        pending = deque()
+        with multiprocessing.Pool(self.threads) as pool, \
+             AtomicOutput(self.out_r1) as r1_out_fh, AtomicOutput(self.out_r2) as r2_out_fh:
+            while True:
+                r1_data, r2_data = self._get(r1_queue, r1_reader), self._get(r2_queue, r2_reader)
+                if r1_data is None or r2_data is None:
+                    if r1_data is not r2_data:
+                        raise Exception("R1 and R2 have different numbers of records!!")
+                    break
+                    
+                r1_block, r2_block = FastqBlock(r1_data), FastqBlock(r2_data)
+                if r1_block.n != r2_block.n:
+                    raise Exception("R1 and R2 have different numbers of records!!")
+                if not (r1_block.headers_ok() and r2_block.headers_ok()):
+                    raise Exception("Not at the start of a record!!")
+                
+                keep = self.filters.mask(r1_block, r2_block)
+                    
+                in_count += r1_block.n
+                out_count += np.count_nonzero(keep)
+                pending.append((pool.apply_async(gzip.compress, (r1_block.select(keep),)),
+                                pool.apply_async(gzip.compress, (r2_block.select(keep),))))
                 
-        print("In : {0} Failed: ".format(in_count) + "\t".join([str(f) for f in self.filters]))
+                # Write out in order once the pool is saturated
+                while len(pending) > 2*self.threads:
+                    r1_res, r2_res = pending.popleft()
+                    r1_out_fh.write(r1_res.get())
+                    r2_out_fh.write(r2_res.get())
+                    
+            while pending:
+                r1_res, r2_res = pending.popleft()
+                r1_out_fh.write(r1_res.get())
+                r2_out_fh.write(r2_res.get())
+        
+        r1_reader.join()
+        r2_reader.join()
+        
+        self.report(in_count, start)
 
     
 if __name__ == '__main__':
@@ -98,6 +480,22 @@ if __name__ == '__main__':
     parser.add_argument('out_R1')
     parser.add_argument('out_R2')
     parser.add_argument('-L', required=False, default=101)
+    parser.add_argument('--engine', choices=['python', 'block'], default='python')
+    parser.add_argument('--threads', required=False, default=1, type=int)
+    parser.add_argument('--min-qual', required=False, default=None, type=int, help="Minimum mean base quality")
+    parser.add_argument('--adapter', required=False, action='append', help="Adapter sequence to filter, may be repeated")
+    parser.add_argument('--polyA', required=False, default=0, type=int, help="Length of poly-A run to filter")
+    parser.add_argument('--min-entropy', required=False, default=None, type=float, help="Minimum base composition entropy in bits")
     args = parser.parse_args()
     
-    FastqFilter(args.in_R1, args.in_R2, args.out_R1, args.out_R2, [no_Ns(), exact_length(int(args.L))])
+    filters = [no_Ns(), exact_length(int(args.L))]
+    if args.min_qual is not None:
+        filters.append(mean_quality(args.min_qual))
+    if args.adapter or args.polyA:
+        filters.append(adapter_match(args.adapter or [], args.polyA))
+    if args.min_entropy is not None:
+        filters.append(low_complexity(args.min_entropy))
+    if args.engine == 'block':
+        BlockFastqFilter(args.in_R1, args.in_R2, args.out_R1, args.out_R2, filters, threads=args.threads)
+    else:
+        FastqFilter(args.in_R1, args.in_R2, args.out_R1, args.out_R2, filters)
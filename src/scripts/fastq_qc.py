@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import os
+import argparse
+import multiprocessing
+
+import numpy as np
+import matplotlib
+matplotlib.use('agg')
+import matplotlib.pyplot as plt
+
+from fastq_filter import FastqBlock, iter_blocks
+
+N_QUAL = 94 # Printable phred+33 range '!' to '~'
+NUCLEOTIDES = 'ACGTN'
+
+# Map bytes to columns of the nucleotide histogram, anything else goes in a discarded final column
+NT_INDEX = np.full(256, len(NUCLEOTIDES), dtype=np.int64)
+for i, b in enumerate(NUCLEOTIDES.encode()):
+    NT_INDEX[b] = i
+
+STATS_HEADER = ["column", "count", "min", "max", "sum", "mean", "Q1", "med", "Q3", "IQR", "lW", "rW",
+                "A_Count", "C_Count", "G_Count", "T_Count", "N_Count", "Max_count"]
+
+class QualityStats():
+    '''Per-cycle histograms of quality scores and nucleotides, accumulated one :class:`FastqBlock` at a time.
+    The summary statistics are derived from the histograms, so memory is bounded by the read length
+    :param offset: Quality encoding offset
+    '''
+    def __init__(self, offset=33):
+        self.offset = offset
+        self.qual = np.zeros((0, N_QUAL), dtype=np.int64)
+        self.nt = np.zeros((0, len(NUCLEOTIDES)), dtype=np.int64)
+
+    def _grow(self, cycles):
+        if cycles > len(self.qual):
+            self.qual = np.vstack([self.qual, np.zeros((cycles - len(self.qual), N_QUAL), dtype=np.int64)])
+            self.nt = np.vstack([self.nt, np.zeros((cycles - len(self.nt), len(NUCLEOTIDES)), dtype=np.int64)])
+
+    @staticmethod
+    def _positions(start, length):
+        '''Byte position and cycle number of every base in the lines given by ``start``, ``length``'''
+        cycle = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+        return np.repeat(start, length) + cycle, cycle
+
+    def update(self, block):
+        if block.n == 0:
+            return
+        self._grow(int(max(block.qual_len.max(), block.seq_len.max())))
+        cycles = len(self.qual)
+
+        pos, cycle = self._positions(block.qual_start, block.qual_len)
+        q = block.arr[pos].astype(np.int64) - self.offset
+        if len(q) and (q.min() < 0 or q.max() >= N_QUAL):
+            raise Exception("Quality score out of range, is the offset {0} correct?".format(self.offset))
+        self.qual += np.bincount(cycle*N_QUAL + q, minlength=cycles*N_QUAL).reshape(cycles, N_QUAL)
+
+        pos, cycle = self._positions(block.seq_start, block.seq_len)
+        nt = NT_INDEX[block.arr[pos]]
+        width = len(NUCLEOTIDES) + 1
+        self.nt += np.bincount(cycle*width + nt, minlength=cycles*width).reshape(cycles, width)[:, :-1]
+
+    def _nth(self, n):
+        '''The quality score of the ``n``th read in each cycle'''
+        return np.argmax(np.cumsum(self.qual, axis=1) >= np.maximum(n, 1)[:, None], axis=1)
+
+    def table(self):
+        '''Summary statistics per cycle, in the column layout of fastx_quality_stats'''
+        count = self.qual.sum(axis=1)
+        scores = np.arange(N_QUAL)
+        seen = self.qual > 0
+        qmin = np.argmax(seen, axis=1)
+        qmax = N_QUAL - 1 - np.argmax(seen[:, ::-1], axis=1)
+        qsum = (self.qual*scores).sum(axis=1)
+        q1, med, q3 = self._nth(count//4), self._nth(count//2), self._nth(count*3//4)
+        iqr = q3 - q1
+        lw = np.maximum(q1 - iqr*3//2, qmin)
+        rw = np.minimum(q3 + iqr*3//2, qmax)
+
+        rows = []
+        for c in range(len(count)):
+            rows.append([c + 1, count[c], qmin[c], qmax[c], qsum[c], "{0:.2f}".format(qsum[c]/max(count[c], 1)),
+                         q1[c], med[c], q3[c], iqr[c], lw[c], rw[c]] + list(self.nt[c]) + [count.max()])
+        return rows
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write("\t".join(STATS_HEADER) + "\n")
+            for row in self.table():
+                f.write("\t".join([str(x) for x in row]) + "\n")
+
+    def plot_quality(self, path, title):
+        rows = self.table()
+        boxes = [{'med':r[7], 'q1':r[6], 'q3':r[8], 'whislo':r[10], 'whishi':r[11], 'fliers':[]} for r in rows]
+        fig, ax = plt.subplots(figsize=(max(8, len(rows)/8), 6))
+        ax.bxp(boxes, showfliers=False)
+        ax.set_xticks(range(1, len(rows) + 1, 10))
+        ax.set_xticklabels(range(1, len(rows) + 1, 10))
+        ax.set_xlabel('Read position')
+        ax.set_ylabel('Quality score')
+        ax.set_title(title)
+        fig.savefig(path)
+        plt.close(fig)
+
+    def plot_nucleotides(self, path, title):
+        pc = 100*self.nt/np.maximum(self.nt.sum(axis=1), 1)[:, None]
+        fig, ax = plt.subplots(figsize=(max(8, len(pc)/8), 6))
+        bottom = np.zeros(len(pc))
+        x = np.arange(1, len(pc) + 1)
+        for i, nt in enumerate(NUCLEOTIDES):
+            ax.bar(x, pc[:, i], bottom=bottom, width=1, label=nt)
+            bottom += pc[:, i]
+        ax.set_xlim(0.5, len(pc) + 0.5)
+        ax.set_ylim(0, 100)
+        ax.set_xlabel('Read position')
+        ax.set_ylabel('Nucleotide %')
+        ax.set_title(title)
+        ax.legend(loc='upper right')
+        fig.savefig(path)
+        plt.close(fig)
+
+def qc_mate(in_fastq, prefix, mate, tee=None, block_records=2**14):
+    '''Accumulate the stats for one mate in a single decompression pass, writing the stats table and plots.
+    If ``tee`` is given the decompressed fastq is also written there, eg to a fifo read by Trimmomatic'''
+    stats = QualityStats()
+    tee_fh = open(tee, 'wb') if tee else None
+    try:
+        for data in iter_blocks(in_fastq, block_records):
+            if tee_fh:
+                tee_fh.write(data)
+            stats.update(FastqBlock(data))
+    finally:
+        if tee_fh:
+            tee_fh.close()
+
+    title = os.path.basename(prefix) + "_" + mate
+    stats.write(prefix + "_" + mate + "_stats.txt")
+    stats.plot_quality(prefix + "_" + mate + "_quality.png", title)
+    stats.plot_nucleotides(prefix + "_" + mate + "_nt_distr.png", title)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('in_R1')
+    parser.add_argument('in_R2')
+    parser.add_argument('prefix', help="Outputs are written to prefix_R1_stats.txt, prefix_R1_quality.png etc")
+    parser.add_argument('--tee', nargs=2, required=False, default=[None, None], metavar=('R1', 'R2'),
+                        help="Also write the decompressed R1 and R2 here")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.prefix)), exist_ok=True)
+    with multiprocessing.Pool(2) as pool:
+        jobs = [pool.apply_async(qc_mate, (args.in_R1, args.prefix, 'R1', args.tee[0])),
+                pool.apply_async(qc_mate, (args.in_R2, args.prefix, 'R2', args.tee[1]))]
+        for j in jobs:
+            j.get()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import fnmatch
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_MAGIC = b'\x1f\x8b'
+BUFFER_SIZE = 2**24
+
+def find_lanes(read_dir, library):
+    '''Walk ``read_dir`` once and return the sorted lane files for each mate of ``library``.
+    :param str read_dir: Glob pattern of the directories to search, as passed to find
+    '''
+    lanes = {'R1':[], 'R2':[]}
+    patterns = {mate:"*{0}*_{1}.fastq.gz".format(library, mate) for mate in lanes}
+    for top in glob.glob(read_dir):
+        for root, dirs, files in os.walk(top):
+            for f in files:
+                for mate, pattern in patterns.items():
+                    if fnmatch.fnmatchcase(f, pattern):
+                        lanes[mate].append(os.path.join(root, f))
+    return {mate:sorted(paths) for mate, paths in lanes.items()}
+
+def describe(paths):
+    '''Size and mtime of each of ``paths`` as stored in the manifest'''
+    out = []
+    for p in paths:
+        st = os.stat(p)
+        out.append({'path':p, 'size':st.st_size, 'mtime':st.st_mtime})
+    return out
+
+def sources_unchanged(manifest, read_dir=None):
+    '''True if every source file recorded in ``manifest`` still has the same size and mtime. With ``read_dir``
+    the lanes found there for the library must also be the recorded ones, so lanes added since are fetched'''
+    try:
+        with open(manifest, 'r') as f:
+            recorded = json.load(f)
+        if read_dir is not None:
+            lanes = find_lanes(read_dir, recorded['library'])
+            if any(lanes[mate] != [x['path'] for x in recorded[mate]] for mate in ('R1', 'R2')):
+                return False
+        return all(describe([x['path']])[0] == x for mate in ('R1', 'R2') for x in recorded[mate])
+    except (OSError, ValueError, KeyError):
+        return False
+
+def copy_lane(src, dest_fd, offset):
+    '''Copy ``src`` into the open file ``dest_fd`` starting at ``offset``'''
+    with open(src, 'rb', buffering=BUFFER_SIZE) as fh:
+        while True:
+            buf = fh.read(BUFFER_SIZE)
+            if not buf:
+                break
+            written = 0
+            while written < len(buf):
+                written += os.pwrite(dest_fd, buf[written:], offset + written)
+            offset += len(buf)
+
+def check_members(path, lanes):
+    '''Check the concatenated file has the expected size and that a gzip member starts at every lane boundary'''
+    expected = sum(x['size'] for x in lanes)
+    if os.path.getsize(path) != expected:
+        raise Exception("{0} is {1} bytes, expected {2}".format(path, os.path.getsize(path), expected))
+    with open(path, 'rb') as fh:
+        offset = 0
+        for lane in lanes:
+            fh.seek(offset)
+            if fh.read(2) != GZIP_MAGIC:
+                raise Exception("No gzip header at offset {0} of {1} (from {2})".format(offset, path, lane['path']))
+            offset += lane['size']
+
+def fetch(mates, pool):
+    '''Concatenate the lanes of each mate into its output.temp. Every lane of every mate
+    is copied concurrently to its own offset in the output
+    :param mates: List of (lanes, output) tuples
+    '''
+    fds, jobs = [], []
+    try:
+        for lanes, output in mates:
+            fd = os.open(output + '.temp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            fds.append(fd)
+            os.ftruncate(fd, sum(x['size'] for x in lanes))
+            offset = 0
+            for lane in lanes:
+                jobs.append(pool.submit(copy_lane, lane['path'], fd, offset))
+                offset += lane['size']
+        for j in jobs:
+            j.result()
+    finally:
+        for j in jobs:
+            j.cancel()
+        for fd in fds:
+            os.close(fd)
+            
+    for lanes, output in mates:
+        check_members(output + '.temp', lanes)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('read_dir')
+    parser.add_argument('library')
+    parser.add_argument('out_R1')
+    parser.add_argument('out_R2')
+    parser.add_argument('manifest')
+    parser.add_argument('--threads', required=False, default=4, type=int)
+    args = parser.parse_args()
+
+    lanes = find_lanes(args.read_dir, args.library)
+    if len(lanes['R1']) == 0 or len(lanes['R1']) != len(lanes['R2']):
+        raise Exception("Found {0} R1 and {1} R2 lanes for {2}".format(len(lanes['R1']), len(lanes['R2']), args.library))
+    manifest = {'library':args.library, 'R1':describe(lanes['R1']), 'R2':describe(lanes['R2'])}
+
+    try:
+        with open(args.manifest, 'r') as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+
+    if (previous == manifest and
+        all(os.path.exists(out) and os.path.getsize(out) == sum(x['size'] for x in manifest[mate])
+            for mate, out in (('R1', args.out_R1), ('R2', args.out_R2)))):
+        print("Sources for {0} unchanged, skipping fetch".format(args.library))
+
+    else:
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            fetch([(manifest['R1'], args.out_R1), (manifest['R2'], args.out_R2)], pool)
+
+        os.replace(args.out_R1 + '.temp', args.out_R1)
+        os.replace(args.out_R2 + '.temp', args.out_R2)
+        with open(args.manifest + '.temp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(args.manifest + '.temp', args.manifest)
+
+        print("Fetched {0} lanes for {1}".format(len(lanes['R1']), args.library))
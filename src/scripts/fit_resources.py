@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+import os
+import json
+import argparse
+import numpy as np
+
+from postmortem import parse_slurm_time, to_gigabytes, read_store
+
+# Ugly hack
+cache_dir = os.path.join(os.path.split(os.path.split(os.path.split(os.path.abspath(__file__))[0])[0])[0], 'cache')
+
+def upper_fit(x, y):
+    '''Least squares line through (x, y) moved up to bound every point, with a non-negative slope'''
+    if len(set(x)) > 1:
+        slope, intercept = np.polyfit(x, y, 1)
+        slope = max(slope, 0.)
+    else:
+        slope, intercept = 0., 0.
+    intercept = float(np.max(y - slope*x))
+    return [intercept, float(slope)]
+
+def fit_resources(jobs, min_samples=5):
+    '''Fit each task type in ``jobs``, with columns Type, input_gb, MaxRSS (GB), Elapsed and TotalCPU (hours)'''
+    fits = {}
+    for task_type, group in jobs.groupby('Type'):
+        if len(group) < min_samples:
+            continue
+        x = group['input_gb'].values
+        fits[task_type] = {'n':len(group),
+                           'mem':[v*1024 for v in upper_fit(x, group['MaxRSS'].values)],
+                           'hours':upper_fit(x, group['Elapsed'].values),
+                           'cpus':float(np.percentile(group['TotalCPU']/group['Elapsed'].clip(lower=1/3600.), 90))}
+    return fits
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fit the resource model of ModelledResources tasks from the job accounting store")
+    parser.add_argument('--db', default=os.path.join(cache_dir, 'jobs.sqlite'))
+    parser.add_argument('--output', default=os.path.join(cache_dir, 'resource_model.json'))
+    parser.add_argument('--min-samples', default=5, type=int)
+    args = parser.parse_args()
+    
+    jobs = read_store(args.db)
+    jobs = jobs[(jobs['State'] == 'COMPLETED') & (jobs['oom'] == 0)].drop_duplicates('JobID').copy()
+    jobs['input_gb'] = jobs['input_bytes']/1024**3
+    jobs['Elapsed'] = jobs['Elapsed'].map(parse_slurm_time)
+    jobs['TotalCPU'] = jobs['TotalCPU'].map(parse_slurm_time)
+    jobs['MaxRSS'] = jobs['MaxRSS'].fillna('0').replace('', '0').map(to_gigabytes)
+    
+    fits = fit_resources(jobs, args.min_samples)
+    for task_type, fit in sorted(fits.items()):
+        print("{0}: {1} jobs, {2[0]:.0f}MB + {2[1]:.0f}MB/GB, {3[0]:.2f}h + {3[1]:.2f}h/GB, {4:.1f} CPUs".format(
+              task_type, fit['n'], fit['mem'], fit['hours'], fit['cpus']))
+    with open(args.output, 'w') as f:
+        json.dump(fits, f, indent=1)
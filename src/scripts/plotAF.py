@@ -2,31 +2,74 @@
 
 import pandas as pd
 import numpy as np
-import sys, re
-import matplotlib 
+import re, math
+import argparse
+import matplotlib
 matplotlib.use('pdf')
 import matplotlib.pyplot as plt
 
-input_tsv = sys.argv[1]
-output = sys.argv[2]
-
 # Tab separated file with columns 'CHROM', 'POS', 'REF', 'ALT', 'DP', 'LIBxxxx.AD'
 
-tsv = pd.read_table(input_tsv, sep='\t')
+N_BINS = 20
+
+def ranked_freqs(ad):
+    '''Allele frequencies of each site from a Series of comma separated allele depths, as an array with
+    a row per site and the alleles in decreasing order of frequency. Missing and zero are NaN'''
+    counts = ad.str.split(',', expand=True).astype(float).values
+    # Descending with the NaN padding last
+    counts = -np.sort(-counts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        freqs = counts/np.nansum(counts, axis=1)[:, None]
+    freqs[freqs == 0] = float('nan')
+    return freqs
+
+def allele_freq_hist(input_tsv, ad_col_name, chunksize=10**6):
+    '''Histogram the ranked allele frequencies reading the AD column in chunks, so memory does not
+    grow with the number of sites. Returns the bin counts with a row per allele rank and the bin edges'''
+    edges = np.linspace(0, 1, N_BINS + 1)
+    hist = np.zeros((0, N_BINS), dtype=np.int64)
+    for chunk in pd.read_table(input_tsv, sep='\t', usecols=[ad_col_name], dtype=str, chunksize=chunksize):
+        freqs = ranked_freqs(chunk[ad_col_name].dropna())
+        if freqs.shape[1] > hist.shape[0]:
+            hist = np.vstack([hist, np.zeros((freqs.shape[1] - hist.shape[0], N_BINS), dtype=np.int64)])
+        for rank in range(freqs.shape[1]):
+            col = freqs[:, rank]
+            hist[rank] += np.histogram(col[~np.isnan(col)], bins=N_BINS, range=(0, 1))[0]
+    return hist, edges
+
+def layout(n):
+    '''Grid of subplots for n histograms, as pandas DataFrame.hist lays them out'''
+    if n <= 2:
+        return 1, max(n, 1)
+    k = math.ceil(math.sqrt(n))
+    return (k, k - 1) if k*(k - 1) >= n else (k, k)
 
-# If multiple libraries are present, just pull out the first
-ad_col_name = tsv.filter(regex='\S+AD').columns[0]
-lib_name = re.match("(\S+)\.AD", ad_col_name).groups()[0]
+def plot_hist(hist, edges, lib_name, output):
+    nrows, ncols = layout(len(hist))
+    fig, axes = plt.subplots(nrows, ncols, sharex=True, sharey=True, squeeze=False)
+    for rank, ax in enumerate(axes.flat):
+        if rank >= len(hist):
+            ax.set_visible(False)
+            continue
+        ax.bar(edges[:-1], hist[rank], width=np.diff(edges), align='edge')
+        ax.set_title(str(rank))
+        ax.grid(True)
+    fig.suptitle(lib_name,  fontsize=20)
+    fig.text(0.5, 0.04, 'Allele frequency', ha='center')
+    fig.text(0.02, 0.5, 'Counts', va='center', rotation='vertical')
+    fig.savefig(output)
 
-counts = [np.sort([float(y) for y in x.split(',')])[::-1] for x in tsv[ad_col_name]]
-freqs = [x/np.sum(x) for x in counts]
-df = pd.DataFrame(freqs)
-df[df==0] = float('nan')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plot histograms of the ranked allele frequencies from VariantsToTable output")
+    parser.add_argument('input_tsv')
+    parser.add_argument('output')
+    parser.add_argument('--chunksize', required=False, default=10**6, type=int, help="Sites read at a time")
+    args = parser.parse_args()
 
-ax_list = df.hist(sharex=True, sharey=True, range=(0,1), bins=20)
-fig = ax_list.flat[0].get_figure()
-plt.gcf().suptitle(lib_name,  fontsize=20)
-plt.gcf().text(0.5, 0.04, 'Allele frequency', ha='center')
-plt.gcf().text(0.02, 0.5, 'Counts', va='center', rotation='vertical')
+    # If multiple libraries are present, just pull out the first
+    columns = pd.read_table(args.input_tsv, sep='\t', nrows=0).columns
+    ad_col_name = [x for x in columns if re.search('\S+AD', x)][0]
+    lib_name = re.match("(\S+)\.AD", ad_col_name).groups()[0]
 
-plt.gcf().savefig(output)
+    hist, edges = allele_freq_hist(args.input_tsv, ad_col_name, args.chunksize)
+    plot_hist(hist, edges, lib_name, args.output)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import sys,os,re,io, math
+import sqlite3
 import subprocess
 from collections import namedtuple
 import pandas as pd
@@ -10,6 +11,8 @@ matplotlib.use('pdf')
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
+from sacct_fields import SACCT_FIELDS
+
 fastq_path = '/tgac/scratch/buntingd'
 bam_path = '/tgac/scratch/buntingd'
 
@@ -25,9 +28,10 @@ def parse_slurm_time(t_str):
     # format is [DD-[hh:]]mm:ss
     # return decimal hours
     s1 = t_str.split(':')
-    # always have mins/secs
-    secs = int(s1[-1])
+    # always have mins/secs, TotalCPU has fractional secs
+    secs = float(s1[-1])
     mins = int(s1[-2])
+    hours, days = 0, 0
     
     if len(s1) > 2:
         s2 = s1[0].split('-')
@@ -39,6 +43,30 @@ def parse_slurm_time(t_str):
             days = int(s2[0])
     return 24*days + hours + mins/60. + secs/(60.**2)
     
+def backfill_store(db, chunk=500):
+    '''Query sacct for just the jobs in the store whose usage was not yet accounted when they finished'''
+    with sqlite3.connect(db) as conn:
+        jobids = [r[0] for r in conn.execute("SELECT DISTINCT jobid FROM jobs WHERE jobid IS NOT NULL AND "
+                                             "(state IS NULL OR state IN ('', 'PENDING', 'RUNNING'))")]
+        for i in range(0, len(jobids), chunk):
+            jobid_query = ','.join([x + '.0' for x in jobids[i:i + chunk]])
+            p = subprocess.run("sacct -n -P --format=JobID," + ",".join([x[0] for x in SACCT_FIELDS]) + " -j " + jobid_query,
+                               shell=True, universal_newlines=True, stdout=subprocess.PIPE)
+            for line in p.stdout.splitlines():
+                fields = line.split('|')
+                conn.execute("UPDATE jobs SET " + ", ".join([x[1] + "=?" for x in SACCT_FIELDS]) + " WHERE jobid=?",
+                             fields[1:] + [fields[0].split('.')[0]])
+        conn.commit()
+    return len(jobids)
+
+def read_store(db):
+    '''Task table of every job in the job accounting store, with the sacct columns as sacct names them'''
+    backfill_store(db)
+    with sqlite3.connect(db) as conn:
+        return pd.read_sql_query("SELECT jobid AS JobID, type AS Type, library AS Lib, input_bytes, oom, " +
+                                 ", ".join([x[1] + " AS " + x[0] for x in SACCT_FIELDS]) +
+                                 " FROM jobs WHERE jobid IS NOT NULL", conn)
+    
 class Task():
     def __init__(self, task_id, jobid):
         super(Task).__init__()
@@ -53,28 +81,33 @@ class Task():
         self.jobid = jobid
     
 if __name__ == '__main__':
+    # Either the job accounting store (cache/jobs.sqlite) and an output directory,
+    # or a task-id/jobid TSV whose jobs are all fetched from sacct
     task_file = sys.argv[1]
-    base_dir = task_file.rsplit(".", 1)[0]
+    base_dir = sys.argv[2] if len(sys.argv) > 2 else task_file.rsplit(".", 1)[0]
    
-    tasks = {}
-    with open(task_file, 'r') as f:
-        for line in f:
-            task_id, jobid = line.rstrip().split('\t')
-            tasks[jobid] = Task(task_id, jobid)
-    
-    jobid_query = ','.join([t.jobid+'.0' for t in tasks.values()])
-    p = subprocess.run("sacct -P --format=jobid,elapsed,MaxDiskWrite,MaxDiskRead,AveRSS,MaxRSS,AveVMSize,MaxVMSize,state,ExitCode -j " + jobid_query, shell=True, universal_newlines=True, stdout=subprocess.PIPE)
-    task_table = pd.read_table(io.StringIO(p.stdout), sep='|')
-    
-    task_table['JobID'] = task_table['JobID'].astype(str).str.split('.').str.get(0)
-    task_table['Lib'] = [tasks[jid].lib for jid in task_table['JobID']]
-    task_table['Type'] = [tasks[jid].type for jid in task_table['JobID']]
+    if task_file.endswith('.sqlite'):
+        task_table = read_store(task_file)
+    else:
+        tasks = {}
+        with open(task_file, 'r') as f:
+            for line in f:
+                task_id, jobid = line.rstrip().split('\t')
+                tasks[jobid] = Task(task_id, jobid)
+        
+        jobid_query = ','.join([t.jobid+'.0' for t in tasks.values()])
+        p = subprocess.run("sacct -P --format=jobid,elapsed,MaxDiskWrite,MaxDiskRead,AveRSS,MaxRSS,AveVMSize,MaxVMSize,state,ExitCode -j " + jobid_query, shell=True, universal_newlines=True, stdout=subprocess.PIPE)
+        task_table = pd.read_table(io.StringIO(p.stdout), sep='|')
+        
+        task_table['JobID'] = task_table['JobID'].astype(str).str.split('.').str.get(0)
+        task_table['Lib'] = [tasks[jid].lib for jid in task_table['JobID']]
+        task_table['Type'] = [tasks[jid].type for jid in task_table['JobID']]
     
-    task_table['Elapsed'] = task_table['Elapsed'].map(parse_slurm_time)
+    # Jobs still running, or that sacct never returned, have no usage to parse
+    completed = task_table[(task_table['State'] == 'COMPLETED') & task_table['Elapsed'].notnull()].copy()
+    completed['Elapsed'] = completed['Elapsed'].map(parse_slurm_time)
     for mem in ['MaxDiskWrite','MaxDiskRead','AveRSS','MaxRSS','AveVMSize','MaxVMSize']:
-        task_table[mem] = task_table[mem].map(to_gigabytes)
-    
-    completed = task_table.ix[task_table['State'] == 'COMPLETED']
+        completed[mem] = completed[mem].map(to_gigabytes)
         
     ## By Res
     res_path = os.path.join(base_dir, 'by_res')
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+
+# sacct fields of the job step kept in the jobs table of the job accounting store
+# (src/utils.py JobAccounting), with the columns they are stored in
+SACCT_FIELDS = [('State', 'state'), ('ExitCode', 'exit_code'), ('Elapsed', 'elapsed'), ('TotalCPU', 'total_cpu'),
+                ('MaxRSS', 'max_rss'), ('AveRSS', 'ave_rss'), ('MaxVMSize', 'max_vmsize'), ('AveVMSize', 'ave_vmsize'),
+                ('MaxDiskRead', 'max_disk_read'), ('MaxDiskWrite', 'max_disk_write')]
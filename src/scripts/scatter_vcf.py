@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+
+import os
+import re
+import gzip
+import zlib
+import struct
+import argparse
+from bisect import bisect_left
+from collections import deque
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
+
+BGZF_BLOCK = 0xff00 # Uncompressed bytes per BGZF block, as used by htslib
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+TBI_VCF = 2
+END_RE = re.compile(rb'(?:^|;)END=(\d+)')
+CONTIG_RE = re.compile(rb'^##contig=<.*?ID=([^,>]+).*?length=(\d+)')
+
+###############################################################################
+#                                  BGZF                                       #
+###############################################################################
+
+def bgzf_compress(data, level=6):
+    '''Compress ``data`` (at most BGZF_BLOCK bytes) into a single BGZF block.
+    zlib releases the GIL so blocks can be compressed on a thread pool'''
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = c.compress(data) + c.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, 18 + len(deflated) + 8 - 1)
+    return header + deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+class BGZFWriter():
+    '''Writes a BGZF file with the blocks compressed in order on ``pool``.
+    ``offset`` is the number of uncompressed bytes written so far, after close()
+    voffset() converts these offsets to BGZF virtual offsets for indexing
+    '''
+    def __init__(self, path, pool, level=6, max_pending=16):
+        self.path = path
+        self.pool = pool
+        self.level = level
+        self.max_pending = max_pending
+        self.fh = open(path, 'wb')
+        self.buf = bytearray()
+        self.offset = 0
+        self.pending = deque()
+        self.block_sizes = []
+
+    def write(self, data):
+        self.buf += data
+        self.offset += len(data)
+        while len(self.buf) >= BGZF_BLOCK:
+            self._submit(bytes(self.buf[:BGZF_BLOCK]))
+            del self.buf[:BGZF_BLOCK]
+
+    def _submit(self, block):
+        self.pending.append(self.pool.submit(bgzf_compress, block, self.level))
+        while len(self.pending) > self.max_pending:
+            self._drain()
+
+    def _drain(self):
+        data = self.pending.popleft().result()
+        self.fh.write(data)
+        self.block_sizes.append(len(data))
+
+    def close(self):
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self._drain()
+        self.fh.write(BGZF_EOF)
+        self.fh.close()
+        self.block_starts = list(accumulate([0] + self.block_sizes))
+
+    def voffset(self, offset):
+        block, within = divmod(offset, BGZF_BLOCK)
+        return (self.block_starts[block] << 16) | within
+
+###############################################################################
+#                                  Tabix                                      #
+###############################################################################
+
+def reg2bin(beg, end):
+    '''UCSC binning scheme bin of the 0-based half open interval [beg, end)'''
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+class TabixIndex():
+    '''Builds a tabix index for a VCF as the records are written. Record offsets are in the uncompressed
+    stream and are converted to virtual offsets when the index is written'''
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+
+    def add(self, chrom, beg, end, off_beg, off_end):
+        if chrom not in self.refs:
+            self.names.append(chrom)
+            self.refs[chrom] = ({}, {})
+        bins, linear = self.refs[chrom]
+
+        chunks = bins.setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == off_beg:
+            chunks[-1][1] = off_end
+        else:
+            chunks.append([off_beg, off_end])
+
+        for w in range(beg >> 14, ((end - 1) >> 14) + 1):
+            if w not in linear:
+                linear[w] = off_beg
+
+    def write(self, path, voffset, pool):
+        names = b''.join([n + b'\0' for n in self.names])
+        out = [b'TBI\1', struct.pack('<8i', len(self.names), TBI_VCF, 1, 2, 0, ord('#'), 0, len(names)), names]
+        for n in self.names:
+            bins, linear = self.refs[n]
+            out.append(struct.pack('<i', len(bins)))
+            for b, chunks in sorted(bins.items()):
+                out.append(struct.pack('<Ii', b, len(chunks)))
+                out.extend([struct.pack('<QQ', voffset(s), voffset(e)) for s,e in chunks])
+
+            # Windows without records take the offset of the previous window
+            ioff, prev = [], linear[min(linear)]
+            for w in range(max(linear) + 1):
+                prev = linear.get(w, prev)
+                ioff.append(voffset(prev))
+            out.append(struct.pack('<i', len(ioff)))
+            out.append(struct.pack('<{0}Q'.format(len(ioff)), *ioff))
+
+        writer = BGZFWriter(path, pool)
+        writer.write(b''.join(out))
+        writer.close()
+
+###############################################################################
+#                                 Scatter                                     #
+###############################################################################
+
+class Shard():
+    '''A bgzipped, tabix indexed VCF shard'''
+    def __init__(self, path, header, pool):
+        self.path = path
+        self.pool = pool
+        self.writer = BGZFWriter(path, pool)
+        self.writer.write(header)
+        self.index = TabixIndex()
+        self.records = 0
+
+    def add(self, line, chrom, beg, end):
+        off_beg = self.writer.offset
+        self.writer.write(line)
+        self.index.add(chrom, beg, end, off_beg, self.writer.offset)
+        self.records += 1
+
+    def close(self):
+        self.writer.close()
+        self.index.write(self.path + '.tbi', self.writer.voffset, self.pool)
+
+def iter_lines(path, chunk_size=2**24):
+    '''Yield each line of the bgzipped ``path`` and the fraction of the compressed file consumed'''
+    total = max(os.path.getsize(path), 1)
+    with open(path, 'rb', buffering=2**27) as raw:
+        fh = gzip.GzipFile(mode='r', fileobj=raw)
+        rem, last_tell = b'', 0
+        while True:
+            chunk = fh.read(chunk_size)
+            tell = raw.tell()
+            data = rem + chunk
+            lines = data.split(b'\n')
+            rem = lines.pop() if chunk else b''
+            if not chunk and lines == [b'']:
+                lines = []
+
+            done, step = 0, (tell - last_tell)/max(len(data), 1)
+            for line in lines:
+                done += len(line) + 1
+                yield line + b'\n', (last_tell + done*step)/total
+            last_tell = tell
+            if not chunk:
+                break
+
+def count_records(path):
+    '''Count the records in the bgzipped VCF ``path`` with a decompression pass'''
+    count, header_lines, in_header = 0, 0, True
+    with gzip.open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(2**24)
+            if not chunk:
+                break
+            count += chunk.count(b'\n')
+            if in_header:
+                for line in chunk.split(b'\n'):
+                    if not line.startswith(b'#'):
+                        in_header = False
+                        break
+                    header_lines += 1
+    return count - header_lines
+
+def parse_record(line):
+    '''Chromosome and 0-based half open interval of a VCF record, using INFO/END if present'''
+    fields = line.split(b'\t', 8)
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    if len(fields) > 7:
+        m = END_RE.search(fields[7])
+        if m:
+            end = max(end, int(m.group(1)))
+    return fields[0], beg, end
+
+def scatter_vcf(input_vcf, prefix, N, split_by='size', threads=1):
+    '''Split ``input_vcf`` into ``N`` bgzipped and tabix indexed shards named prefix_i.vcf.gz.
+    Shards are only ever split between distinct positions. ``split_by`` balances the shards by:
+        size: the compressed input consumed, approximately the record content, without an extra pass
+        records: the number of records, counted with an extra decompression pass
+        position: the genomic coordinate, using the contig lengths in the header
+    '''
+    total_records = count_records(input_vcf) if split_by == 'records' else None
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        header, shards = [], []
+        contig_offsets, genome_length = {}, 0
+        last_pos, n_records = None, 0
+
+        for line, consumed in iter_lines(input_vcf):
+            if not shards:
+                # Catch the header
+                if line.startswith(b'#'):
+                    header.append(line)
+                    m = CONTIG_RE.match(line)
+                    if m:
+                        contig_offsets[m.group(1)] = genome_length
+                        genome_length += int(m.group(2))
+                    continue
+                elif not header:
+                    raise Exception("No header on input VCF")
+                if split_by == 'position' and genome_length == 0:
+                    print("No contig lengths in the header, splitting by size")
+                    split_by = 'size'
+                header = b''.join(header)
+                shards.append(Shard("{0}_0.vcf.gz".format(prefix), header, pool))
+                # Don't count the header towards the size of the first shard
+                header_consumed = consumed
+
+            chrom, beg, end = parse_record(line)
+            if (chrom, beg) != last_pos and len(shards) < N:
+                if split_by == 'records':
+                    progress = n_records/max(total_records, 1)
+                elif split_by == 'position':
+                    progress = (contig_offsets.get(chrom, 0) + beg)/genome_length
+                else:
+                    progress = (consumed - header_consumed)/max(1 - header_consumed, 1e-9)
+
+                if progress >= len(shards)/N:
+                    # Filled this shard, start compressing the next
+                    print("Closing {0} with {1} records".format(shards[-1].path, shards[-1].records))
+                    shards[-1].close()
+                    shards.append(Shard("{0}_{1}.vcf.gz".format(prefix, len(shards)), header, pool))
+
+            shards[-1].add(line, chrom, beg, end)
+            last_pos = (chrom, beg)
+            n_records += 1
+
+        if not shards:
+            if not header:
+                raise Exception("No header on input VCF")
+            header = b''.join(header)
+            shards.append(Shard("{0}_0.vcf.gz".format(prefix), header, pool))
+
+        # Too few distinct positions to fill every shard, the rest are header only
+        while len(shards) < N:
+            shards[-1].close()
+            shards.append(Shard("{0}_{1}.vcf.gz".format(prefix, len(shards)), header, pool))
+        print("Closing {0} with {1} records".format(shards[-1].path, shards[-1].records))
+        shards[-1].close()
+
+###############################################################################
+#                              Region scatter                                 #
+###############################################################################
+
+def read_tbi(path):
+    '''Names and linear index (virtual offset of the first record in each 16kb window) of each
+    reference in the tabix index ``path``. The bins are skipped'''
+    with gzip.open(path, 'rb') as fh:
+        data = fh.read()
+    if data[:4] != b'TBI\1':
+        raise Exception("{0} is not a tabix index".format(path))
+    n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = struct.unpack_from('<8i', data, 4)
+    names = data[36:36 + l_nm].split(b'\0')[:n_ref]
+    refs, p = [], 36 + l_nm
+    for name in names:
+        n_bin, = struct.unpack_from('<i', data, p)
+        p += 4
+        for b in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, p)
+            p += 8 + 16*n_chunk
+        n_intv, = struct.unpack_from('<i', data, p)
+        refs.append((name, list(struct.unpack_from('<{0}Q'.format(n_intv), data, p + 4))))
+        p += 4 + 8*n_intv
+    return refs
+
+def read_contig_lengths(path):
+    '''Contig lengths from the ##contig lines of the header of the bgzipped VCF ``path``'''
+    lengths = {}
+    with gzip.open(path, 'rb') as fh:
+        for line in fh:
+            if not line.startswith(b'##'):
+                break
+            m = CONTIG_RE.match(line)
+            if m:
+                lengths[m.group(1)] = int(m.group(2))
+    return lengths
+
+def iter_records_from(path, voffset):
+    '''Yield (chrom, beg, end) of the records of the bgzipped VCF ``path`` from ``voffset`` onwards'''
+    with open(path, 'rb') as raw:
+        raw.seek(voffset >> 16)
+        fh = gzip.GzipFile(mode='r', fileobj=raw)
+        fh.read(voffset & 0xffff)
+        for line in fh:
+            if not line.startswith(b'#'):
+                yield parse_record(line)
+
+def safe_boundary(path, name, ioff, pos):
+    '''Move the split at 0-based ``pos`` of contig ``name`` forward until no record spans it, so a record
+    can't be picked up by the shards either side of the split by tools that select by overlap (eg GATK -L)'''
+    if pos == 0:
+        return pos
+    for chrom, beg, end in iter_records_from(path, ioff[max((pos >> 14) - 1, 0)]):
+        if chrom != name or beg >= pos:
+            break
+        pos = max(pos, end)
+    return pos
+
+def scatter_regions(input_vcf, N):
+    '''Split the tabix indexed ``input_vcf`` into ``N`` lists of regions without reading the records.
+    The splits are placed in the linear index so each holds about the same amount of compressed data,
+    then moved to a position no record spans. Returns a list of up to N lists of BED (chrom, beg, end) tuples,
+    fewer when the index has too few windows to give every shard some of the VCF'''
+    refs = read_tbi(input_vcf + '.tbi')
+    if not refs:
+        raise Exception("{0}.tbi has no references".format(input_vcf))
+    lengths = read_contig_lengths(input_vcf)
+    length = lambda r: lengths.get(refs[r][0], len(refs[r][1]) << 14)
+
+    # Every 16kb window is a candidate split, at the compressed offset its records start
+    points = [(r, w) for r, (name, ioff) in enumerate(refs) for w in range(len(ioff))]
+    N = min(N, len(points))
+    coffsets = [refs[r][1][w] >> 16 for r, w in points]
+    start, end = coffsets[0], os.path.getsize(input_vcf)
+
+    bounds = [(0, 0)]
+    for k in range(1, N):
+        r, w = points[min(bisect_left(coffsets, start + (end - start)*k/N), len(points) - 1)]
+        pos = w << 14
+        if (r, pos) <= bounds[-1]:
+            # Too little data for N distinct splits, give this shard at least one base
+            r, pos = bounds[-1][0], bounds[-1][1] + 1
+        pos = safe_boundary(input_vcf, refs[r][0], refs[r][1], pos)
+        bounds.append((r + 1, 0) if pos >= length(r) and r + 1 < len(refs) else (r, pos))
+    bounds.append((len(refs), 0))
+
+    shards = []
+    for (ra, pa), (rb, pb) in zip(bounds[:-1], bounds[1:]):
+        regions = []
+        for r in range(ra, min(rb + 1, len(refs))):
+            beg = pa if r == ra else 0
+            end = pb if r == rb else length(r)
+            if end > beg:
+                regions.append((refs[r][0].decode(), beg, end))
+        if regions:
+            shards.append(regions)
+    return shards
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_vcf')
+    parser.add_argument('prefix')
+    parser.add_argument('N', type=int)
+    parser.add_argument('--split-by', choices=['size', 'records', 'position'], default='size')
+    parser.add_argument('--threads', required=False, default=1, type=int)
+    args = parser.parse_args()
+
+    scatter_vcf(args.input_vcf, args.prefix, args.N, args.split_by, args.threads)
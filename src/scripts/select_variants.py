@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from scatter_vcf import Shard, parse_record
+
+# Selections as (variant types, biallelic only), mirroring the SelectVariants
+# options of GetSNPs, GetINDELs and GetRefSNPs in Callset.py
+SELECTIONS = {'snps':(('SNP',), True),
+              'indels':(('MNP', 'MIXED'), False),
+              'ref_snps':(('SYMBOLIC', 'NO_VARIATION', 'SNP'), True)}
+
+def is_symbolic(allele):
+    return len(allele) > 1 and (allele[:1] in b'<.' or allele[-1:] in b'>.' or b'[' in allele or b']' in allele)
+
+def allele_type(ref, alt):
+    '''Type of the biallelic variant ref -> alt, as in htsjdk VariantContext'''
+    if is_symbolic(alt):
+        return 'SYMBOLIC'
+    elif len(ref) == len(alt):
+        return 'SNP' if len(ref) == 1 else 'MNP'
+    return 'INDEL'
+
+def variant_type(ref, alts):
+    '''Type of a site from its REF and list of ALT alleles, as in htsjdk VariantContext.getType'''
+    if not alts:
+        return 'NO_VARIATION'
+    types = set([allele_type(ref, alt) for alt in alts])
+    return types.pop() if len(types) == 1 else 'MIXED'
+
+def select_variants(in_fh, outputs, threads=1):
+    '''Write every record read from the VCF ``in_fh`` to outputs['filtered'] and those matching each of
+    SELECTIONS to outputs[selection], each bgzipped and tabix indexed, in one pass
+    :param dict outputs: output path of 'filtered' and of each of SELECTIONS to write
+    '''
+    selections = [(name, set(SELECTIONS[name][0]), SELECTIONS[name][1]) for name in SELECTIONS if name in outputs]
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        header, shards = [], None
+        for line in in_fh:
+            if shards is None:
+                if line.startswith(b'#'):
+                    header.append(line)
+                    continue
+                shards = dict([(name, Shard(path, b''.join(header), pool)) for name, path in outputs.items()])
+
+            chrom, beg, end = parse_record(line)
+            fields = line.split(b'\t', 5)
+            alts = [] if fields[4] in (b'.', b'') else fields[4].split(b',')
+            vtype = variant_type(fields[3], alts)
+
+            shards['filtered'].add(line, chrom, beg, end)
+            for name, types, biallelic in selections:
+                # Sites without an ALT allele pass the biallelic restriction, as in GetRefSNPs
+                if vtype in types and not (biallelic and len(alts) > 1):
+                    shards[name].add(line, chrom, beg, end)
+
+        if shards is None:
+            if not header:
+                raise Exception("No header on input VCF")
+            shards = dict([(name, Shard(path, b''.join(header), pool)) for name, path in outputs.items()])
+
+        for name, shard in shards.items():
+            print("{0}: {1} records".format(shard.path, shard.records))
+            shard.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Split a filtered VCF read from stdin into its SNP, INDEL and RefSNP selections")
+    parser.add_argument('filtered', help="Output path of every record")
+    parser.add_argument('--snps', required=False, default=None)
+    parser.add_argument('--indels', required=False, default=None)
+    parser.add_argument('--ref-snps', required=False, default=None)
+    parser.add_argument('--threads', required=False, default=1, type=int)
+    args = parser.parse_args()
+
+    outputs = {'filtered':args.filtered}
+    outputs.update(dict([(name, getattr(args, name)) for name in SELECTIONS if getattr(args, name)]))
+    select_variants(sys.stdin.buffer, outputs, args.threads)
@@ -1,12 +1,28 @@
 import luigi
 import os
+import json
+import math
 import gzip
+import struct
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 import subprocess
 import pandas as pd
+import pysam
 import hashlib
 import inspect
 
+from src.scripts.sacct_fields import SACCT_FIELDS
+
+import logging
+logger = logging.getLogger('luigi-interface')
+
+# Ugly hack
+cache_dir = os.path.join(os.path.split(os.path.split(__file__)[0])[0], 'cache')
+
 ###############################################################################
 #                         Testing file emptiness                              #
 ###############################################################################
@@ -20,19 +36,32 @@ def isNePlain(fname):
     return  os.path.getsize(fname) > 0
     
 def isNeBam(fname):
-    r = subprocess.run("set -o pipefail; source samtools-0.1.19 && samtools view {0} | head -c1 ".format(fname), shell=True, stdout=subprocess.PIPE)
-
-    if r.returncode == 1:
-        # samtools will return 1 if fname is not a valid bam
-        # Check specifically for 1 rather than !=0 as if
-        # The file is bam and non-empty head causes the retcode to be SIGPIPE 141
-        raise subprocess.CalledProcessError(r.returncode, str(r.args))
+    '''Reads the BAM header directly from the first BGZF blocks and checks whether any alignment follows it.
+    Raises OSError if fname is not a valid BAM'''
+    with gzip.open(fname, 'rb') as f:
         
-    return len(r.stdout) > 0
+        def read_exactly(n):
+            data = f.read(n)
+            if len(data) != n:
+                raise OSError("{0} is truncated or not a BAM file".format(fname))
+            return data
+            
+        if f.read(4) != b'BAM\1':
+            raise OSError("{0} is not a BAM file".format(fname))
+        l_text, = struct.unpack('<i', read_exactly(4))
+        read_exactly(l_text)
+        n_ref, = struct.unpack('<i', read_exactly(4))
+        for _ in range(n_ref):
+            l_name, = struct.unpack('<i', read_exactly(4))
+            read_exactly(l_name + 4)
+            
+        # The first alignment record starts with its 4 byte block_size
+        return len(f.read(4)) > 0
     
 extensions_dispath = defaultdict(lambda : isNePlain, {'bam':isNeBam,
                                                       'gz':isNeGz})
-def is_not_empty(fname):
+
+def _is_not_empty(fname):
 
     try:
         # Try dispatching to handler determmined by file extension
@@ -42,12 +71,138 @@ def is_not_empty(fname):
     except ValueError:
         try:
             return isNeBam(fname)
-        except CalledProcessError:
+        except OSError:
             try:
                 return isNeGz(fname)
             except OSError:
                 return  os.path.getsize(fname) > 0
+
+class SqliteStore(object):
+    '''A small sqlite database that is safe to share between threads and forked luigi
+    workers, each process opens its own connection. Any error disables the store
+    rather than failing the pipeline
+    :param list schema: statements run on each new connection'''
+    schema = []
     
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._disabled = False
+        
+    def _connect(self):
+        if self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            for statement in self.schema:
+                self._conn.execute(statement)
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+        
+    def _query(self, sql, params, commit=False):
+        if self._disabled:
+            return None
+        try:
+            with self._lock:
+                conn = self._connect()
+                rows = conn.execute(sql, params).fetchall()
+                if commit:
+                    conn.commit()
+                return rows
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Disabling {0} {1}: {2}".format(self.__class__.__name__, self.path, e))
+            self._disabled = True
+            return None
+
+class NonEmptyCache(SqliteStore):
+    '''Persistent cache of file emptiness keyed on (path, size, mtime), so
+    unchanged outputs are never re-inspected'''
+    schema = ["CREATE TABLE IF NOT EXISTS nonempty (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, nonempty INTEGER)"]
+    
+    def get(self, fname, size, mtime):
+        rows = self._query("SELECT nonempty FROM nonempty WHERE path=? AND size=? AND mtime=?", (fname, size, mtime))
+        return bool(rows[0][0]) if rows else None
+        
+    def put(self, fname, size, mtime, nonempty):
+        self._query("INSERT OR REPLACE INTO nonempty VALUES (?, ?, ?, ?)", (fname, size, mtime, int(nonempty)), commit=True)
+
+nonempty_cache = NonEmptyCache(os.path.join(cache_dir, 'nonempty.sqlite'))
+
+def is_not_empty(fname):
+    '''Check whether fname has any content, using nonempty_cache to skip files seen before'''
+    fname = os.path.abspath(fname)
+    st = os.stat(fname)
+    if st.st_size == 0:
+        return False
+        
+    cached = nonempty_cache.get(fname, st.st_size, st.st_mtime)
+    if cached is not None:
+        return cached
+        
+    result = _is_not_empty(fname)
+    nonempty_cache.put(fname, st.st_size, st.st_mtime, result)
+    return result
+    
+###############################################################################
+#                       Parallel completeness checks                          #
+###############################################################################
+
+# Paths of the outputs of the tasks prefetch_complete found to be complete, by task_id
+completed_tasks = {}
+
+class PrefetchedComplete(object):
+    '''Mixin that short-circuits complete() for tasks that prefetch_complete has already found to be complete'''
+    def complete(self):
+        if self.task_id in completed_tasks:
+            return True
+        return super().complete()
+
+def discard_completed(path):
+    '''Forget that prefetch_complete found complete any task with an output at or under :param: path,
+    for tasks that remove the outputs of others'''
+    path = os.path.abspath(path)
+    for task_id, outputs in list(completed_tasks.items()):
+        if any([x == path or x.startswith(path + os.sep) for x in outputs]):
+            del completed_tasks[task_id]
+
+def prefetch_complete(task, threads=32):
+    '''Evaluate complete() for the tasks upstream of :param: task concurrently on a thread pool, so the
+    filesystem stats and emptiness checks against NFS overlap. The DAG is walked a level at a time and, as
+    luigi does, not past complete tasks. Complete tasks are recorded in completed_tasks so the scheduler's
+    own serial complete() calls return immediately for any task using PrefetchedComplete.
+    Wrapper tasks are not checked as their completeness is derived from their requirements'''
+    start = time.time()
+    seen, level, n_checked = set([task.task_id]), [task], 0
+    
+    def check(t):
+        try:
+            return t.task_id, t.complete()
+        except Exception as e:
+            logger.debug("Prefetching complete() of {0} failed: {1}".format(t.task_id, e))
+            return t.task_id, False
+        
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while level:
+            checked = [t for t in level if not isinstance(t, luigi.WrapperTask)]
+            done = dict(pool.map(check, checked))
+            n_checked += len(checked)
+            
+            upstream = []
+            for t in level:
+                if done.get(t.task_id):
+                    completed_tasks[t.task_id] = [os.path.abspath(x.path) for x in luigi.task.flatten(t.output())
+                                                  if hasattr(x, 'path')]
+                    continue
+                for dep in luigi.task.flatten(t.deps()):
+                    if dep.task_id not in seen:
+                        seen.add(dep.task_id)
+                        upstream.append(dep)
+            level = upstream
+                
+    logger.info("Checked completeness of {0} tasks in {1:.1f}s".format(n_checked, time.time() - start))
+
 class CheckTargetNonEmpty(object): 
     '''This is mixin class that can be added to a luigi task to cause it to fail if the produced output is exists but is empty
         Handles checking compressed files which can have nonzero size but still be empty'''
@@ -56,6 +211,171 @@ class CheckTargetNonEmpty(object):
         return super().complete() and all(map(is_not_empty, [x.path for x in outputs]))
 
 
+###############################################################################
+#                             Resource model                                  #
+###############################################################################
+
+def parse_size_mb(size):
+    '''A size from sacct such as 1536K or 2.5G in MB'''
+    size = size.strip()
+    if not size:
+        return 0.
+    unit = size[-1].upper()
+    if unit in 'KMGT':
+        return float(size[:-1])*1024**('KMGT'.index(unit) - 1)
+    return float(size)/1024**2
+
+class JobIds(logging.Handler):
+    '''Collects the SLURM jobid of each task from the "task_id<tab>jobid" records written to alloc_log'''
+    def __init__(self):
+        super().__init__()
+        self.jobids = {}
+        
+    def emit(self, record):
+        fields = record.getMessage().strip().split('\t')
+        if len(fields) >= 2:
+            self.jobids[fields[0]] = fields[-1]
+
+job_ids = JobIds()
+logging.getLogger('alloc_log').addHandler(job_ids)
+
+def sacct_step(jobid):
+    '''The SACCT_FIELDS of the job step jobid.0 as sacct reports them, or {} if sacct fails'''
+    try:
+        p = subprocess.run("sacct -n -P --format=" + ",".join([x[0] for x in SACCT_FIELDS]) + " -j " + jobid + ".0",
+                           shell=True, universal_newlines=True, stdout=subprocess.PIPE)
+    except OSError:
+        return {}
+    lines = p.stdout.splitlines()
+    if p.returncode != 0 or not lines:
+        return {}
+    return dict(zip([x[1] for x in SACCT_FIELDS], lines[0].split('|')))
+
+class JobAccounting(SqliteStore):
+    '''Accounting of every job run by a ModelledResources task: its allocation, input size and the sacct
+    usage of its step when it finished. The sacct fields are kept as reported, so scripts/postmortem.py
+    parses them as before and fills in any that were not yet available. Also holds the memory step-up
+    of tasks that ran out of memory'''
+    schema = ["CREATE TABLE IF NOT EXISTS jobs (task_id TEXT, type TEXT, library TEXT, jobid TEXT, input_bytes INTEGER, "
+              "mem INTEGER, n_cpu INTEGER, partition TEXT, submitted REAL, finished REAL, oom INTEGER, " +
+              ", ".join([x[1] + " TEXT" for x in SACCT_FIELDS]) + ")",
+              "CREATE INDEX IF NOT EXISTS jobs_type ON jobs (type)",
+              "CREATE INDEX IF NOT EXISTS jobs_library ON jobs (library)",
+              "CREATE INDEX IF NOT EXISTS jobs_jobid ON jobs (jobid)",
+              "CREATE TABLE IF NOT EXISTS stepups (task_id TEXT PRIMARY KEY, factor REAL)"]
+    
+    def record(self, task, jobid, input_bytes, submitted, oom):
+        usage = sacct_step(jobid) if jobid is not None else {}
+        self._query("INSERT INTO jobs VALUES (" + ", ".join(["?"]*(11 + len(SACCT_FIELDS))) + ")",
+                    [task.task_id, task.task_family, getattr(task, 'library', None) or '', jobid, input_bytes,
+                     task.mem, task.n_cpu, task.partition, submitted, time.time(), int(oom)] +
+                    [usage.get(x[1]) for x in SACCT_FIELDS], commit=True)
+        
+    def stepup(self, task_id):
+        rows = self._query("SELECT factor FROM stepups WHERE task_id=?", (task_id,))
+        return rows[0][0] if rows else 1.
+        
+    def set_stepup(self, task_id, factor):
+        self._query("INSERT OR REPLACE INTO stepups VALUES (?, ?)", (task_id, factor), commit=True)
+
+job_accounting = JobAccounting(os.path.join(cache_dir, 'jobs.sqlite'))
+
+class ResourceModel(object):
+    '''Per task type upper bounds on peak memory (MB) and elapsed time (hours), linear in the input size
+    in GB, and the CPUs used, as fitted by scripts/fit_resources.py'''
+    def __init__(self, path):
+        self.path = path
+        self._fits = None
+        
+    def fits(self):
+        if self._fits is None:
+            try:
+                with open(self.path) as f:
+                    self._fits = json.load(f)
+            except (OSError, ValueError):
+                self._fits = {}
+        return self._fits
+        
+    def predict(self, task_type, input_bytes):
+        '''Returns dict of mem, cpus and hours, or None if there is no fit for task_type'''
+        fit = self.fits().get(task_type)
+        if fit is None:
+            return None
+        size = input_bytes/1024**3
+        return {'mem':fit['mem'][0] + fit['mem'][1]*size,
+                'cpus':fit['cpus'],
+                'hours':fit['hours'][0] + fit['hours'][1]*size}
+
+resource_model = ResourceModel(os.path.join(cache_dir, 'resource_model.json'))
+
+class ModelledResources(object):
+    '''Mixin for SlurmExecutableTask that replaces the mem, n_cpu and partition set in __init__ with the
+    predictions of resource_model for the size of the inputs, just before the job is submitted. The __init__
+    values stand for task types without a fit, and n_cpu is never raised above them. Every job is recorded
+    in job_accounting when it finishes.
+    Options in the [resources] section of luigi.cfg:
+        margin: multiplies the predicted memory, CPUs and time (1.2)
+        min_mem: smallest total memory in MB to ask for (500)
+        partitions: partitions by walltime in hours, eg tgac-short:2,tgac-medium:48. Unset keeps the partition
+        oom_step: the memory of every later attempt is scaled by this after a job runs out of memory (1.5)
+        oom_rss_fraction: also take a failed job whose MaxRSS reached this fraction of its memory to have run
+            out of memory. Unset, only jobs sacct reports as OUT_OF_MEMORY are'''
+    def input_bytes(self):
+        return sum([os.path.getsize(x.path) for x in luigi.task.flatten(self.input())
+                    if hasattr(x, 'path') and os.path.isfile(x.path)])
+        
+    def apply_resource_model(self, input_bytes):
+        # Retries of the same task object start again from the __init__ values, not from the last attempt's
+        if not hasattr(self, '_init_resources'):
+            self._init_resources = (self.mem, self.n_cpu, self.partition)
+        self.mem, self.n_cpu, self.partition = self._init_resources
+        config = luigi.configuration.get_config()
+        margin = config.getfloat('resources', 'margin', 1.2)
+        prediction = resource_model.predict(self.task_family, input_bytes)
+        if prediction is not None:
+            self.n_cpu = max(1, min(self.n_cpu, math.ceil(prediction['cpus']*margin)))
+            self.mem = math.ceil(max(prediction['mem']*margin, config.getint('resources', 'min_mem', 500))/self.n_cpu)
+            partitions = config.get('resources', 'partitions', '')
+            for partition in [x.split(':') for x in partitions.split(',') if x]:
+                if prediction['hours']*margin <= float(partition[1]):
+                    self.partition = partition[0]
+                    break
+        self.mem = math.ceil(self.mem*job_accounting.stepup(self.task_id))
+        logger.info("Resources for {0}: {1} CPUs, {2}MB per CPU on {3}".format(self.task_id, self.n_cpu, self.mem, self.partition))
+        
+    def ran_out_of_memory(self, jobid):
+        '''Whether sacct says the job was killed for exceeding its memory'''
+        rss_fraction = luigi.configuration.get_config().getfloat('resources', 'oom_rss_fraction', 0)
+        try:
+            p = subprocess.run("sacct -n -P --format=State,MaxRSS -j " + jobid, shell=True,
+                               universal_newlines=True, stdout=subprocess.PIPE)
+        except OSError:
+            return False
+        for line in p.stdout.splitlines():
+            state, max_rss = (line.split('|') + [''])[:2]
+            if state.startswith('OUT_OF_MEMORY'):
+                return True
+            if rss_fraction > 0 and parse_size_mb(max_rss) >= rss_fraction*self.mem*self.n_cpu:
+                return True
+        return False
+        
+    def run(self):
+        input_bytes = self.input_bytes()
+        self.apply_resource_model(input_bytes)
+        submitted, oom = time.time(), False
+        try:
+            super().run()
+        except Exception:
+            jobid = job_ids.jobids.get(self.task_id)
+            oom = jobid is not None and self.ran_out_of_memory(jobid)
+            if oom:
+                factor = job_accounting.stepup(self.task_id)*luigi.configuration.get_config().getfloat('resources', 'oom_step', 1.5)
+                logger.warning("{0} ran out of memory, asking for {1:.2f}x on the next attempt".format(self.task_id, factor))
+                job_accounting.set_stepup(self.task_id, factor)
+            raise
+        finally:
+            job_accounting.record(self, job_ids.jobids.get(self.task_id), input_bytes, submitted, oom)
+
 ###############################################################################
 #                           Parsing STAR logs                                  #
 ###############################################################################
@@ -87,6 +407,19 @@ def parseStarLog(logfile, lib):
 
 def parseLibList(liblist, base_dir):
     return pd.DataFrame([parseStarLog(os.path.join(base_dir, lib, 'Log.final.out'), lib) for lib in liblist]).set_index('Library')
+
+def gvcf_path(base_dir, library):
+    '''The bgzipped GVCF from HaplotypeCaller for :param: library, or the uncompressed .g.vcf
+       written before they were compressed if that has not been migrated yet'''
+    path = os.path.join(base_dir, 'libraries', library, library + ".g.vcf.gz")
+    if not os.path.exists(path) and os.path.exists(path[:-len('.gz')]):
+        return path[:-len('.gz')]
+    return path
+
+def has_read_group(bam, sample):
+    '''Whether the header of :param: bam has a read group for :param: sample'''
+    with pysam.AlignmentFile(bam, 'rb') as f:
+        return any([rg.get('SM') == sample for rg in f.header.get('RG', [])])
     
     
 ###############################################################################